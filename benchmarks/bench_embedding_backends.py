@@ -0,0 +1,120 @@
+"""Compares the embedding.SentenceTransformer backends on a fixed corpus: throughput of
+embed_many, single-query latency of embed, and agreement with the fp32 torch backend
+(the one stored embeddings were computed with). Agreement is the cosine similarity
+between the two backends' vectors of each text, and the overlap of each text's nearest
+neighbours when it is embedded with the backend and searched among fp32 vectors.
+
+Run from the repository root (TORCH_HOME must be set):
+    python -m benchmarks.bench_embedding_backends --backends torch,torch_int8,onnx
+    python -m benchmarks.bench_embedding_backends --from_database  # needs POSTGRES_URL
+"""
+from lib import embedding
+import argparse
+import random
+import time
+import numpy as np
+
+WORDS = (
+    "we propose a novel method for training large language models with sparse "
+    "attention and show that it improves sample efficiency on reinforcement learning "
+    "benchmarks while reducing memory the approach combines diffusion models graph "
+    "neural networks and contrastive pretraining to learn robust representations of "
+    "images text and molecules experiments on standard datasets demonstrate state of "
+    "the art results in classification retrieval and generation under distribution "
+    "shift with theoretical guarantees on convergence and generalization"
+).split()
+
+
+def synthetic_corpus(num_texts, seed=0):
+    """Deterministic abstract-like texts of varying length."""
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 250)))
+        for _ in range(num_texts)
+    ]
+
+
+def load_database_corpus(num_texts):
+    from lib import database
+
+    abstracts = []
+    for entity in database.Database().iter_papers(columns=["arxiv_id", "abstract"]):
+        if entity.paper.abstract:
+            abstracts.append(entity.paper.abstract)
+        if len(abstracts) == num_texts:
+            break
+    return abstracts
+
+
+def single_query_latencies_ms(model, queries):
+    model.embed(queries[:1])  # warm up
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        model.embed([query])
+        latencies.append(1000 * (time.perf_counter() - start))
+    return np.array(latencies)
+
+
+def neighbour_overlap(embeddings, reference, k):
+    """Mean overlap between the top `k` fp32 neighbours of each text's `embeddings`
+    vector and of its `reference` vector."""
+    overlaps = []
+    for query, reference_query in zip(embeddings, reference):
+        top = set(np.argsort(-(reference @ query))[:k])
+        reference_top = set(np.argsort(-(reference @ reference_query))[:k])
+        overlaps.append(len(top & reference_top) / k)
+    return float(np.mean(overlaps))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", default=",".join(embedding.BACKENDS))
+    parser.add_argument("--num_texts", type=int, default=2000)
+    parser.add_argument("--num_queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--from_database", action="store_true")
+    args = parser.parse_args()
+
+    if args.from_database:
+        corpus = load_database_corpus(args.num_texts)
+    else:
+        corpus = synthetic_corpus(args.num_texts)
+    # Search queries are short, so time single queries on a few words each.
+    queries = [" ".join(text.split()[:8]) for text in corpus[: args.num_queries]]
+    backends = args.backends.split(",")
+    # Every backend is compared against fp32 torch, so compute its vectors first.
+    if "torch" in backends:
+        backends.remove("torch")
+    backends.insert(0, "torch")
+
+    print(f"{len(corpus)} texts, {len(queries)} single queries")
+    print(
+        f"{'backend':<12}{'texts/s':>9}{'p50 ms':>9}{'p99 ms':>9}"
+        f"{'mean cos':>10}{'min cos':>9}{f'top{args.k} overlap':>15}"
+    )
+    reference = None
+    for backend in backends:
+        model = embedding.SentenceTransformer(
+            num_threads=args.num_threads, backend=backend
+        )
+        model.embed_many(corpus[:64])  # warm up
+        start = time.perf_counter()
+        embeddings = model.embed_many(corpus)
+        texts_per_second = len(corpus) / (time.perf_counter() - start)
+        latencies = single_query_latencies_ms(model, queries)
+        if reference is None:
+            reference = embeddings
+        cosines = np.sum(embeddings * reference, axis=1)
+        overlap = neighbour_overlap(embeddings[: args.num_queries], reference, args.k)
+        print(
+            f"{backend:<12}{texts_per_second:>9.1f}"
+            f"{np.percentile(latencies, 50):>9.2f}{np.percentile(latencies, 99):>9.2f}"
+            f"{cosines.mean():>10.4f}{cosines.min():>9.4f}{overlap:>15.3f}"
+        )
+        del model
+
+
+if __name__ == "__main__":
+    main()
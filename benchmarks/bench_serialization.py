@@ -0,0 +1,117 @@
+"""Measures the CPU time spent turning /search result rows into a response body, with
+the original path (validated pydantic models + jsonable_encoder) and the fast path
+(unvalidated models + lib.serialization). No database is needed.
+
+Run from the repository root:
+    python -m benchmarks.bench_serialization --top_k 500
+"""
+from lib import database, serialization
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from datetime import datetime, timedelta
+import argparse
+import json
+import random
+import time
+
+# Columns returned by Database.get_similar_papers, in order.
+COLUMNS = [
+    "arxiv_id",
+    "title",
+    "abstract",
+    "published_ts",
+    "tw_likes",
+    "tw_retweets",
+    "tw_replies",
+    "tw_quotes",
+    "tw_impressions",
+    "hn_points",
+    "hn_num_comments",
+    "summary",
+    "popularity",
+]
+
+
+def make_rows(n, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1)
+    rows = []
+    for i in range(n):
+        counts = [rng.randint(0, 500) for _ in range(7)]
+        rows.append(
+            (
+                f"2301.{i:05d}",
+                f"Paper title {i}",
+                " ".join(["word"] * 200),
+                start + timedelta(minutes=rng.randint(0, 500000)),
+                *counts,
+                None,
+                rng.random() * 10,
+                rng.random(),  # similarity
+                rng.random(),  # lexical rank
+            )
+        )
+    return rows
+
+
+def validated_path(db, rows):
+    col_idx = db._list_index_map(COLUMNS)
+    results = [
+        database.SimilarityResult(
+            entity=db._row_to_arxiv_entity(row, col_idx),
+            similarity=row[len(COLUMNS)],
+            lexical_rank=row[len(COLUMNS) + 1],
+        )
+        for row in rows
+    ]
+    return JSONResponse(content=jsonable_encoder({"data": results})).body
+
+
+def fast_path(db, rows, media_type=serialization.JSON_MEDIA_TYPE):
+    results = db._rows_to_similarity_results(rows, COLUMNS, lexical_rank_query="q")
+    return serialization.encode(
+        serialization.search_response(results), media_type=media_type
+    )
+
+
+def cpu_ms_per_call(fn, repeats):
+    fn()  # warm up
+    start = time.process_time()
+    for _ in range(repeats):
+        fn()
+    return 1000 * (time.process_time() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--top_k", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    # The row conversion methods don't touch the connection, so skip creating one.
+    db = database.Database.__new__(database.Database)
+    rows = make_rows(args.top_k)
+
+    if json.loads(validated_path(db, rows)) != json.loads(fast_path(db, rows)):
+        raise AssertionError("Fast path response differs from the validated one.")
+
+    timings = {
+        "validated + jsonable_encoder": cpu_ms_per_call(
+            lambda: validated_path(db, rows), args.repeats
+        ),
+        "fast path (orjson)": cpu_ms_per_call(
+            lambda: fast_path(db, rows), args.repeats
+        ),
+        "fast path (msgpack)": cpu_ms_per_call(
+            lambda: fast_path(db, rows, serialization.MSGPACK_MEDIA_TYPES[0]),
+            args.repeats,
+        ),
+    }
+    baseline = timings["validated + jsonable_encoder"]
+    print(f"CPU time per response, top_k={args.top_k}:")
+    for name, ms in timings.items():
+        print(f"  {name:<30} {ms:8.2f} ms  ({baseline / ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
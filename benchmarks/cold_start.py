@@ -0,0 +1,125 @@
+"""Measures the cold start of the web process.
+
+`startup` launches the server and reports how long until /ping first answers and until
+/ready reports the model as loaded, against target times. By default the server is
+started the way fly.toml starts it, with gunicorn and gunicorn.conf.py.
+
+`importtime` runs `python -X importtime -c "import main"` and sums the self import time
+of every module per top-level package, to show what importing main.py spends its time
+on.
+
+Run from the repository root (with the same environment as the server):
+    python -m benchmarks.cold_start startup --ping_target 1 --ready_target 30
+    python -m benchmarks.cold_start importtime --top 25
+"""
+from collections import defaultdict
+import argparse
+import os
+import subprocess
+import sys
+import time
+import requests
+
+# Imports the app and exits right away, without waiting for the model loading thread.
+IMPORT_MAIN = "import main, os; os._exit(0)"
+
+
+def wait_for(url, process, timeout):
+    """Polls `url` until it answers with a 200. Returns the time it took, or None if
+    the server exited or `timeout` passed first."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            return None
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - start
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.02)
+    return None
+
+
+def measure_startup(args):
+    command = args.command.format(port=args.port).split()
+    base_url = f"http://127.0.0.1:{args.port}"
+    process = subprocess.Popen(command)
+    try:
+        ping = wait_for(f"{base_url}/ping", process, args.timeout)
+        ready = wait_for(f"{base_url}/ready", process, args.timeout)
+    finally:
+        process.terminate()
+        process.wait()
+    # /ready is polled once /ping answers, so both are times since the launch.
+    if ping is not None and ready is not None:
+        ready += ping
+    failed = False
+    for name, elapsed, target in (
+        ("first /ping", ping, args.ping_target),
+        ("/ready", ready, args.ready_target),
+    ):
+        if elapsed is None:
+            print(f"{name:<12} did not answer within {args.timeout}s")
+            failed = True
+            continue
+        ok = elapsed <= target
+        failed |= not ok
+        status = "ok" if ok else "MISSED"
+        print(f"{name:<12} {elapsed:7.2f}s  (target {target}s: {status})")
+    return 1 if failed else 0
+
+
+def parse_importtime(stderr):
+    """Returns {top-level package: total self import time in microseconds}."""
+    totals = defaultdict(int)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        totals[name.strip().split(".")[0]] += int(self_us)
+    return totals
+
+
+def report_importtime(args):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_MAIN],
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    totals = parse_importtime(result.stderr)
+    if not totals:
+        print(result.stderr)
+        return 1
+    total_us = sum(totals.values())
+    print(f"Importing main took {total_us / 1000:.0f}ms in total")
+    print(f"{'package':<30}{'ms':>8}{'share':>8}")
+    for package, us in sorted(totals.items(), key=lambda item: -item[1])[: args.top]:
+        print(f"{package:<30}{us / 1000:>8.1f}{us / total_us:>8.1%}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    startup = subparsers.add_parser("startup")
+    startup.add_argument(
+        "--command",
+        default="gunicorn -c gunicorn.conf.py main:fastapi_app --bind 127.0.0.1:{port}",
+        help="Server command. {port} is replaced with --port.",
+    )
+    startup.add_argument("--port", type=int, default=8765)
+    startup.add_argument("--ping_target", type=float, default=1.0)
+    startup.add_argument("--ready_target", type=float, default=30.0)
+    startup.add_argument("--timeout", type=float, default=120.0)
+    importtime = subparsers.add_parser("importtime")
+    importtime.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    if args.mode == "startup":
+        sys.exit(measure_startup(args))
+    sys.exit(report_importtime(args))
+
+
+if __name__ == "__main__":
+    main()
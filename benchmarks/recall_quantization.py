@@ -0,0 +1,103 @@
+"""Reports recall@k, memory per paper and query latency of the VectorIndex
+quantization modes, with and without rescoring the candidates at full precision (as
+search.search_papers does in Postgres). Ground truth is an exact float32 scan.
+
+Run from the repository root:
+    python -m benchmarks.recall_quantization --num_papers 100000
+    python -m benchmarks.recall_quantization --from_database  # needs POSTGRES_URL
+"""
+from lib import vector_index
+import argparse
+import time
+import numpy as np
+
+
+def synthetic_corpus(num_papers, dim, num_topics=200, seed=0):
+    """Normalized embeddings clustered around random topics, a rough stand-in for
+    paper embeddings."""
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(num_topics, dim)).astype(np.float32)
+    assignments = rng.integers(num_topics, size=num_papers)
+    embeddings = topics[assignments] + rng.normal(size=(num_papers, dim)).astype(
+        np.float32
+    )
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def load_database_corpus():
+    from lib import database
+
+    _, _, embeddings = database.Database().get_embedding_matrix()
+    return embeddings
+
+
+def make_queries(embeddings, num_queries, noise=0.5, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = embeddings[rng.choice(len(embeddings), size=num_queries)]
+    queries = queries + noise * rng.normal(size=queries.shape).astype(np.float32) / (
+        np.sqrt(embeddings.shape[1])
+    )
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def evaluate(index, embeddings, queries, truth, k, rescore):
+    num_candidates = max(k, index.rescore_candidates) if rescore else k
+    recalls = []
+    start = time.perf_counter()
+    for query, true_ids in zip(queries, truth):
+        ids, _ = index.search(query, num_candidates)
+        ids = np.array(ids, dtype=np.int64)
+        if rescore:
+            ids = ids[np.argsort(-(embeddings[ids] @ query), kind="stable")[:k]]
+        recalls.append(len(set(ids[:k]) & set(true_ids)) / k)
+    ms_per_query = 1000 * (time.perf_counter() - start) / len(queries)
+    return float(np.mean(recalls)), ms_per_query
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_papers", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--num_queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore_candidates", type=int, default=200)
+    parser.add_argument("--from_database", action="store_true")
+    args = parser.parse_args()
+
+    if args.from_database:
+        embeddings = load_database_corpus()
+    else:
+        embeddings = synthetic_corpus(args.num_papers, args.dim)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    queries = make_queries(embeddings, args.num_queries)
+    truth = [np.argsort(-(embeddings @ q))[: args.k] for q in queries]
+    # Row numbers as IDs, so results can be rescored against `embeddings`.
+    ids = [str(i) for i in range(len(embeddings))]
+    published = [None] * len(embeddings)
+
+    print(
+        f"{len(embeddings)} papers, dim {embeddings.shape[1]}, "
+        f"{args.num_queries} queries, recall@{args.k}"
+    )
+    print(
+        f"{'mode':<16}{'rescored':<10}{'bytes/paper':>12}{'recall':>9}"
+        f"{'ms/query':>10}"
+    )
+    for quantization in vector_index.QUANTIZATIONS:
+        index = vector_index.VectorIndex(
+            ids,
+            embeddings,
+            published,
+            quantization=quantization,
+            rescore_candidates=args.rescore_candidates,
+        )
+        for rescore in (False, True):
+            recall, ms = evaluate(index, embeddings, queries, truth, args.k, rescore)
+            print(
+                f"{quantization or 'float32':<16}{str(rescore):<10}"
+                f"{index.nbytes / len(index):>12.0f}{recall:>9.3f}{ms:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
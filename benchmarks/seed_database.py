@@ -0,0 +1,59 @@
+"""Seeds a scratch Postgres+pgvector database (e.g. the container of
+benchmarks/docker-compose.yml) with the synthetic corpus of benchmarks.corpus, so the
+app can be load tested locally. Existing tables are dropped.
+
+Run from the repository root:
+    python -m benchmarks.seed_database --num_papers 50000
+"""
+from benchmarks import corpus as corpus_lib
+from lib import database, util
+import argparse
+import logging
+import os
+import psycopg
+
+
+def seed(num_papers, seed=0, batch_size=5000):
+    db = database.Database()
+    db.delete_tables()
+    db.create_tables(embedding_dim=corpus_lib.EMBEDDING_DIM)
+    corpus = corpus_lib.make_corpus(num_papers, seed=seed)
+    for batch in util.batched(corpus.papers, batch_size):
+        db.insert_papers(batch)
+    db.insert_tweets(corpus.tweets)
+    db.insert_hnews(corpus.hnews)
+    db.update_arxiv_social_metrics(update_twitter=True, update_hnews=True)
+    with db._pool_conn() as connection:
+        connection.connection.execute("ANALYZE")
+        connection.connection.commit()
+    logging.info(
+        f"Seeded {len(corpus.papers)} papers, {len(corpus.tweets)} tweets and "
+        f"{len(corpus.hnews)} Hacker News posts."
+    )
+
+
+def main():
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_papers", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--postgres_url",
+        default=util.get_env_var("BENCHMARK_POSTGRES_URL"),
+        help="Scratch database to seed. Defaults to BENCHMARK_POSTGRES_URL.",
+    )
+    args = parser.parse_args()
+    if not args.postgres_url:
+        parser.error("Set --postgres_url or BENCHMARK_POSTGRES_URL.")
+    if args.postgres_url == util.get_env_var("POSTGRES_URL"):
+        parser.error("Refusing to drop the tables of POSTGRES_URL.")
+
+    # The tables use the vector type, which a fresh database doesn't have yet.
+    with psycopg.connect(args.postgres_url, autocommit=True) as conn:
+        conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    os.environ["POSTGRES_URL"] = args.postgres_url
+    seed(args.num_papers, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
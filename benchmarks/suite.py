@@ -0,0 +1,252 @@
+"""Microbenchmarks of the search and ingest hot paths on the synthetic corpus of
+benchmarks.corpus. Results are written as JSON and can be diffed against the results of
+an earlier run, to spot regressions before deploying.
+
+Groups:
+    cpu: Database._row_to_arxiv_entity and arxiv.maybe_text_to_arxiv_ids.
+    embed: SentenceTransformer.embed at several batch sizes (needs TORCH_HOME).
+    db: Database._bulk_insert, insert_papers and get_similar_papers at several corpus
+        sizes. Needs BENCHMARK_POSTGRES_URL, a scratch database: its tables are dropped
+        and recreated.
+
+Timings depend on the machine, so no baseline is checked in. Record one on the machine
+you compare on, then diff later runs against it:
+    python -m benchmarks.suite --output benchmarks/baseline.json
+    python -m benchmarks.suite --baseline benchmarks/baseline.json --output latest.json
+"""
+from benchmarks import corpus as corpus_lib
+from benchmarks.bench_serialization import COLUMNS
+from lib import arxiv, database, util
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+
+GROUPS = ("cpu", "embed", "db")
+
+
+def timed(fn, repeats, items=1):
+    """Runs `fn` `repeats` times and summarizes the wall-clock times."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {
+        "median_ms": 1000 * median,
+        "min_ms": 1000 * min(times),
+        "repeats": repeats,
+        "items": items,
+        "us_per_item": 1e6 * median / items,
+    }
+
+
+# Values of the tw_* and hn_* columns of COLUMNS.
+SOCIAL_VALUES = (3, 1, 0, 0, 250, 12, 4)
+
+
+def paper_rows(papers):
+    """Rows shaped like the ones Database.get_similar_papers reads (see COLUMNS)."""
+    return [
+        (p.arxiv_id, p.title, p.abstract, p.published, *SOCIAL_VALUES, None, 1.5)
+        for p in papers
+    ]
+
+
+def bench_cpu(args):
+    corpus = corpus_lib.make_corpus(args.cpu_papers)
+    # The row conversion methods don't touch the connection, so skip creating one.
+    db = database.Database.__new__(database.Database)
+    rows = paper_rows(corpus.papers)
+    col_idx = db._list_index_map(COLUMNS)
+    texts = corpus_lib.make_post_texts(corpus)
+    results = {}
+    for validate in (True, False):
+        results[f"row_to_arxiv_entity[validate={validate}]"] = timed(
+            lambda validate=validate: [
+                db._row_to_arxiv_entity(row, col_idx, validate=validate) for row in rows
+            ],
+            args.repeats,
+            len(rows),
+        )
+    results["maybe_text_to_arxiv_ids"] = timed(
+        lambda: [arxiv.maybe_text_to_arxiv_ids(text) for text in texts],
+        args.repeats,
+        len(texts),
+    )
+    return results
+
+
+def bench_embed(args):
+    from lib import embedding
+
+    model = embedding.SentenceTransformer()
+    # Titles are about as long as search queries.
+    titles = [p.title for p in corpus_lib.make_corpus(max(args.batch_sizes)).papers]
+    results = {}
+    for batch_size in args.batch_sizes:
+        batch = titles[:batch_size]
+        model.embed(batch)  # warm up
+        results[f"embed[batch_size={batch_size}]"] = timed(
+            lambda: model.embed(batch), args.repeats, batch_size
+        )
+    return results
+
+
+def bench_db(args):
+    url = util.get_env_var("BENCHMARK_POSTGRES_URL")
+    if not url:
+        raise ValueError("The db benchmarks need BENCHMARK_POSTGRES_URL to be set.")
+    if url == util.get_env_var("POSTGRES_URL"):
+        raise ValueError("BENCHMARK_POSTGRES_URL must be a scratch database.")
+    os.environ["POSTGRES_URL"] = url
+    db = database.Database()
+    queries = corpus_lib.random_embeddings(np.random.default_rng(1), args.num_queries)
+    results = {}
+    for size in args.sizes:
+        corpus = corpus_lib.make_corpus(size)
+        db.delete_tables()
+        db.create_tables()
+        results[f"insert_papers[n={size}]"] = timed(
+            lambda: db.insert_papers(corpus.papers), 1, size
+        )
+        db.insert_tweets(corpus.tweets)
+        db.insert_hnews(corpus.hnews)
+        db.update_arxiv_social_metrics(update_twitter=True, update_hnews=True)
+
+        # Upserts every embedding, like update_arxiv_embeddings does.
+        records = [
+            {"arxiv_id": p.arxiv_id, "embedding": np.asarray(p.embedding, np.float32)}
+            for p in corpus.papers
+        ]
+
+        def bulk_insert():
+            with db._pool_conn() as connection:
+                conn = connection.connection
+                with conn.cursor() as cur:
+                    db._bulk_insert(
+                        database.Tables.ARXIV,
+                        records,
+                        cursor=cur,
+                        insert_cols=["embedding"],
+                        binary_types={"arxiv_id": "varchar", "embedding": "vector"},
+                    )
+                conn.commit()
+
+        results[f"_bulk_insert[n={size}]"] = timed(bulk_insert, args.repeats, size)
+
+        with db._pool_conn() as connection:
+            connection.connection.execute("ANALYZE")
+            connection.connection.commit()
+        for require_social in (False, True):
+            name = f"get_similar_papers[n={size},require_social={require_social}]"
+            results[name] = timed(
+                lambda require_social=require_social: [
+                    db.get_similar_papers(
+                        embeddings=[q], top_k=10, require_social=require_social
+                    )
+                    for q in queries
+                ],
+                args.repeats,
+                len(queries),
+            )
+    return results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "git_commit": commit or None,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }
+
+
+def diff(results, baseline, threshold):
+    """Prints each benchmark's change in median time against `baseline`. Returns the
+    names of the ones that got slower by more than `threshold` (a fraction)."""
+    regressions = []
+    print(f"{'benchmark':<56}{'baseline':>11}{'now':>11}{'change':>9}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<56}{'-':>11}{result['median_ms']:>9.2f}ms{'new':>9}")
+            continue
+        change = result["median_ms"] / before["median_ms"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<56}{before['median_ms']:>9.2f}ms{result['median_ms']:>9.2f}ms"
+            f"{change:>+9.1%}{flag}"
+        )
+    for name in baseline.keys() - results.keys():
+        print(f"{name:<56} missing from this run")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", default="cpu", help="Comma-separated GROUPS.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--cpu_papers", type=int, default=2000)
+    parser.add_argument("--batch_sizes", default="1,8,32,128")
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--num_queries", type=int, default=20)
+    parser.add_argument("--output", help="Path to write the results JSON to.")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Slowdown (as a fraction) reported as a regression.",
+    )
+    args = parser.parse_args()
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    args.sizes = [int(s) for s in args.sizes.split(",")]
+    groups = args.groups.split(",")
+    for group in groups:
+        if group not in GROUPS:
+            parser.error(f"Invalid group '{group}'")
+
+    benches = {"cpu": bench_cpu, "embed": bench_embed, "db": bench_db}
+    results = {}
+    for group in groups:
+        print(f"Running {group} benchmarks...")
+        for name, result in benches[group](args).items():
+            results[f"{group}/{name}"] = result
+            print(
+                f"  {name:<54}{result['median_ms']:>10.2f}ms"
+                f"{result['us_per_item']:>12.1f}us/item"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"metadata": metadata(args), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = diff(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.0%}.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# Gunicorn settings for the web process (see fly.toml). Gunicorn reads this file from
+# the working directory.
+import gc
+import os
+import sys
+
+worker_class = "uvicorn.workers.UvicornWorker"
+# Each worker has its own Postgres pools, caches and vector index, so only run more
+# than one if WEB_CONCURRENCY asks for it.
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+# Import the app once in the master and fork the workers from it. With several
+# workers, the model is loaded in the master too (PRELOAD_MODEL, see main.py), so the
+# workers share one copy of its weights copy-on-write instead of each loading its own.
+# Nothing answers until it has loaded then, not even /ping. A single worker has nothing
+# to share, so it loads the model in the background and answers /ping right after the
+# fork. Set PRELOAD_MODEL to override either default, and check the cold start with
+# benchmarks/cold_start.py.
+preload_app = True
+os.environ.setdefault("PRELOAD_MODEL", "1" if workers > 1 else "0")
+
+# Split the cores between the workers, so their forward passes don't oversubscribe the
+# CPU. Set before the app is preloaded, so the model picks it up.
+os.environ.setdefault(
+    "TORCH_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers))
+)
+
+
+def when_ready(server):
+    # Keep the objects of the preloaded app out of the garbage collector's scans, which
+    # would otherwise write to their pages and copy them into every worker.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # The thread count is per process, so set it again in each worker.
+    if "torch" in sys.modules:
+        import torch
+
+        torch.set_num_threads(int(os.environ["TORCH_NUM_THREADS"]))
+    server.log.info(
+        f"Worker {worker.pid} using {os.environ['TORCH_NUM_THREADS']} torch threads"
+    )
@@ -1,4 +1,3 @@
-import arxiv
 import pydantic
 from typing import List, Optional
 import re
@@ -30,6 +29,9 @@ class ArxivPaper(pydantic.BaseModel):
 
 
 def get_paper_info(arxiv_ids):
+    # Only the pipeline fetches papers, so the web process doesn't import the client.
+    import arxiv
+
     results = arxiv.Search(id_list=arxiv_ids, max_results=float("inf")).results()
     return [
         ArxivPaper(
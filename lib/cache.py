@@ -0,0 +1,210 @@
+from collections import OrderedDict
+from lib import util
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache, bounded by the total size of its entries
+    and with optional expiry. Counts hits and misses."""
+
+    def __init__(self, max_size=10000, ttl=None, sizeof=None):
+        """
+        Args:
+            max_size: Maximum total size of the entries, as measured by `sizeof`.
+            ttl: Seconds after which an entry expires. None to never expire.
+            sizeof: Function returning the size of a value. Defaults to 1 per entry,
+                so `max_size` is the maximum number of entries.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sizeof = sizeof or (lambda value: 1)
+        # key -> (value, size, expiry time)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.max_size:
+            return
+        expiry = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expiry)
+            self._size += size
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size": self._size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+class SqliteCache:
+    """Least-recently-used cache stored in a local SQLite file, so that several
+    processes (e.g. gunicorn workers) can share it. Keys are strings and values must be
+    picklable. Hit and miss counts are per process."""
+
+    def __init__(self, path, max_entries=10000, ttl=None):
+        """
+        Args:
+            path: Path of the SQLite file. Created if it doesn't exist.
+            max_entries: Maximum number of entries.
+            ttl: Seconds after which an entry expires. None to never expire.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._num_puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB,
+                    expiry REAL,
+                    accessed REAL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS accessed_idx ON cache (accessed)")
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key, default=None):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value FROM cache WHERE key = ? AND (expiry IS NULL OR expiry >= ?)",
+            (key, now),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        conn = self._conn()
+        now = time.time()
+        expiry = now + self.ttl if self.ttl is not None else None
+        conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (key, pickle.dumps(value), expiry, now),
+        )
+        self._num_puts += 1
+        # Trimming scans the table, so only do it every so often.
+        if self._num_puts % 100 == 0:
+            conn.execute(
+                """
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        self._conn().execute("DELETE FROM cache")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+class DataVersion:
+    """Counter identifying the current state of the database. It is stored in a file so
+    that every process on the machine sees it, and is bumped whenever the pipeline
+    writes new data. Include it in cache keys to invalidate them on new data.
+
+    The counter is per machine: a pipeline run on one machine doesn't bump it on the
+    others, whose caches keep serving the previous data until their own next bump (or
+    restart, with the default path in the temp dir). Point DATA_VERSION_PATH at shared
+    storage if several machines serve the same database.
+
+    The counter must live as long as the caches it invalidates, or it restarts at 0
+    while they still hold entries of version 0. So if the search result cache is
+    persisted (SEARCH_CACHE_PATH), the counter is stored next to it by default."""
+
+    def __init__(self, path=None):
+        self.path = path or util.get_env_var("DATA_VERSION_PATH")
+        if not self.path:
+            cache_path = util.get_env_var("SEARCH_CACHE_PATH")
+            self.path = (
+                f"{cache_path}.data_version"
+                if cache_path
+                else os.path.join(tempfile.gettempdir(), "arxiv_hype_data_version")
+            )
+
+    def get(self):
+        try:
+            with open(self.path, "r") as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump(self):
+        version = self.get() + 1
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(version))
+        os.replace(tmp_path, self.path)
+        return version
@@ -1,17 +1,19 @@
 # Note: the module name is psycopg, not psycopg3
-from lib import arxiv, util, twitter, hnews
+from lib import arxiv, pgvector, util, twitter, hnews, vector_index
 from typing import List, Dict, Any, Iterable
 from enum import Enum
 
 # from psycopg_pool import ConnectionPool
 import psycopg
-from sqlalchemy import create_engine
+from psycopg_pool import AsyncConnectionPool
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import NamedTuple, Optional
-import json
+import numpy as np
 import pydantic
 import logging
+import asyncio
+import threading
 
 """"
 discarding closed connection: <psycopg.Connection [BAD] at 0x7fcc04da7d30>
@@ -35,6 +37,7 @@ class Tables(str, Enum):
     ARXIV_TWEET = "ArxivTweet"
     HNEWS = "HNews"
     ARXIV_HNEWS = "ArxivHNews"
+    TWEET_EMBED = "TweetEmbed"
 
 
 class ArxivEntity(pydantic.BaseModel):
@@ -48,11 +51,51 @@ class ArxivEntity(pydantic.BaseModel):
     # HNews
     points: Optional[int] = None
     num_comments: Optional[int] = None
+    # Log-scaled engagement across sources (see POPULARITY_SQL)
+    popularity: Optional[float] = None
 
 
 class SimilarityResult(pydantic.BaseModel):
     entity: ArxivEntity
     similarity: float
+    lexical_rank: Optional[float] = None
+    # Blended ranking score (see ranking.rank_results)
+    score: Optional[float] = None
+
+
+class TweetMetrics(pydantic.BaseModel):
+    tweet_id: str
+    created_at: Optional[datetime] = None
+    likes: Optional[int] = None
+    retweets: Optional[int] = None
+    replies: Optional[int] = None
+    quotes: Optional[int] = None
+    impressions: Optional[int] = None
+
+
+class HNewsMetrics(pydantic.BaseModel):
+    hnews_id: str
+    created_at: Optional[datetime] = None
+    points: Optional[int] = None
+    num_comments: Optional[int] = None
+
+
+class PaperSocial(pydantic.BaseModel):
+    """Tweets and Hacker News items mentioning a paper, most engaging first."""
+
+    arxiv_id: str
+    tweets: List[TweetMetrics] = []
+    hnews: List[HNewsMetrics] = []
+
+
+class PaperFilters(pydantic.BaseModel):
+    """Conditions on the Arxiv table. Unset fields don't filter."""
+
+    arxiv_ids: Optional[List[str]] = None
+    # Only papers which have these fields as NULL are returned.
+    required_null_fields: Optional[List[str]] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
 
 
 PRIMARY_KEYS = {
@@ -63,9 +106,10 @@ PRIMARY_KEYS = {
     Tables.ARXIV_TWEET: ("arxiv_id", "tweet_id"),
     Tables.HNEWS: ("hnews_id",),
     Tables.ARXIV_HNEWS: ("hnews_id", "arxiv_id"),
+    Tables.TWEET_EMBED: ("tweet_id",),
 }
 
-GENERATED_COLUMNS = {Tables.ARXIV: ("text_search_vector",)}
+GENERATED_COLUMNS = {Tables.ARXIV: ("text_search_vector", "popularity")}
 
 MAX_AUTHOR_LEN = 256
 MAX_CATEGORY_LEN = 32
@@ -79,6 +123,66 @@ TWITTER_SOCIAL_ARXIV_COLUMNS = [
 HNEWS_SOCIAL_ARXIV_COLUMNS = ["points", "num_comments"]
 SOCIAL_ARXIV_COLUMNS = TWITTER_SOCIAL_ARXIV_COLUMNS + HNEWS_SOCIAL_ARXIV_COLUMNS
 
+# Weight of each social column in the popularity score. Keep in sync with
+# ranking.popularity_scores.
+POPULARITY_WEIGHTS = {
+    "tw_likes": 1,
+    "tw_retweets": 2,
+    "tw_replies": 5,
+    "tw_quotes": 5,
+    "tw_impressions": 0.001,
+    "hn_points": 1,
+    "hn_num_comments": 2,
+}
+TEXT_SEARCH_VECTOR_SQL = (
+    "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(abstract, ''))"
+)
+
+# Foreign keys referencing the Arxiv table, as (table, constraint name).
+ARXIV_FOREIGN_KEYS = [
+    (Tables.ARXIV_AUTHORS, "fk_author_arxiv"),
+    (Tables.ARXIV_CATEGORY, "fk_arxivcategory_arxiv"),
+    (Tables.ARXIV_TWEET, "fk_arxivtweet_arxiv"),
+    (Tables.ARXIV_HNEWS, "fk_arxivhnews_arxiv"),
+]
+
+# Arxiv IDs have started with the year and month (YYMM) since April 2007. The two digit
+# year wraps after 2099.
+ARXIV_MONTH_ID_START = datetime(2007, 4, 1)
+ARXIV_MONTH_ID_END = datetime(2100, 1, 1)
+
+
+def arxiv_id_month(month, offset=0):
+    """Returns the YYMM arxiv ID prefix `offset` months after `month`, which is
+    either a datetime or a YYMM prefix."""
+    if isinstance(month, str):
+        month = datetime(2000 + int(month[:2]), int(month[2:4]), 1)
+    year, month_idx = divmod(month.year * 12 + month.month - 1 + offset, 12)
+    return f"{year % 100:02d}{month_idx + 1:02d}"
+
+
+def arxiv_id_month_bound(date, offset=0):
+    """Returns the YYMM arxiv ID prefix `offset` months after `date`, or None if
+    either month is outside the range of YYMM IDs, where prefixes don't sort by date.
+    """
+    year = (date.year * 12 + date.month - 1 + offset) // 12
+    if not ARXIV_MONTH_ID_START <= date < ARXIV_MONTH_ID_END or year >= 2100:
+        return None
+    return arxiv_id_month(date, offset)
+
+
+POPULARITY_SQL = "ln(1 + {0})".format(
+    " + ".join(
+        [f"{w} * coalesce({c}, 0)::float8" for c, w in POPULARITY_WEIGHTS.items()]
+    )
+)
+# Condition of the require_social filter: any engagement. Unlike popularity > 0, it
+# leaves out impressions.
+SOCIAL_ENGAGEMENT_SQL = (
+    "(tw_likes > 0 OR tw_retweets > 0 OR tw_quotes > 0 OR tw_replies > 0"
+    " OR hn_points > 0 OR hn_num_comments > 0)"
+)
+
 
 class Database:
     """Contains methods for interacting with the backend PostgreSQL database."""
@@ -87,20 +191,43 @@ class Database:
         credentials = PostgresCredentials(
             url=util.get_env_var("POSTGRES_URL").replace("postgresql://", "")
         )
-        self._engine = create_engine(
-            f"postgresql+psycopg://{credentials.url}",
-            max_overflow=5,
-            pool_size=5,
-            pool_pre_ping=True,
-        )
+        self._conninfo = f"postgresql://{credentials.url}"
+        self._engine_url = f"postgresql+psycopg://{credentials.url}"
+        # Created on first use (see _get_engine), so that constructing a Database
+        # (e.g. at web startup) doesn't pay for importing SQLAlchemy.
+        self._engine = None
+        self._engine_lock = threading.Lock()
         # self._pool = ConnectionPool(credentials.url, max_idle=4 * 60)
         self._table_columns = {}
 
+    @staticmethod
+    def _on_connect(dbapi_connection, connection_record):
+        pgvector.register_vector(dbapi_connection)
+        dbapi_connection.commit()
+
+    def _get_engine(self):
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    from sqlalchemy import create_engine, event
+
+                    engine = create_engine(
+                        self._engine_url,
+                        max_overflow=5,
+                        pool_size=5,
+                        pool_pre_ping=True,
+                    )
+                    event.listen(engine, "connect", self._on_connect)
+                    self._engine = engine
+        return self._engine
+
     def _pool_conn(self):
-        return self._engine.connect()
+        return self._get_engine().connect()
 
-    def create_tables(self, embedding_dim=384):
-        """Creates the necessary tables, assuming embeddings are `embedding_dim` size."""
+    @staticmethod
+    def _arxiv_table_queries(embedding_dim):
+        """Queries creating the Arxiv table and its indexes. The table is partitioned by
+        the month prefix of arxiv IDs (see create_arxiv_partitions)."""
         q = []
         # Arxiv Table Query
         q.append(
@@ -119,19 +246,43 @@ class Database:
             hn_points INTEGER,
             hn_num_comments INTEGER,
             summary TEXT,
+            popularity DOUBLE PRECISION GENERATED ALWAYS AS ({POPULARITY_SQL}) STORED,
+            text_search_vector tsvector GENERATED ALWAYS AS ({TEXT_SEARCH_VECTOR_SQL}) STORED,
 
             PRIMARY KEY (arxiv_id)
-        );
+        ) PARTITION BY RANGE (arxiv_id);
+
+        CREATE INDEX IF NOT EXISTS text_search_idx
+            ON {Tables.ARXIV} USING GIN (text_search_vector)
+        """
+        )
 
+        # Materialized popularity score, kept up to date by Postgres whenever the
+        # social columns change. Added separately so existing tables are migrated.
+        q.append(
+            f"""
         ALTER TABLE {Tables.ARXIV}
-            ADD COLUMN text_search_vector tsvector
-                    GENERATED ALWAYS AS 
-                    (to_tsvector('english', coalesce(title, '') || ' ' || coalesce(abstract, ''))) STORED;
-        
-        CREATE INDEX text_search_idx ON {Tables.ARXIV} USING GIN (text_search_vector)
+            ADD COLUMN IF NOT EXISTS popularity DOUBLE PRECISION
+                GENERATED ALWAYS AS ({POPULARITY_SQL}) STORED;
+
+        CREATE INDEX IF NOT EXISTS popularity_idx ON {Tables.ARXIV} (popularity DESC)
+        """
+        )
+
+        # Used by date filters and for paging through papers (see iter_papers).
+        q.append(
+            f"""
+        CREATE INDEX IF NOT EXISTS published_ts_idx
+            ON {Tables.ARXIV} (published_ts, arxiv_id)
         """
         )
-        q.pop()
+        return q
+
+    def create_tables(self, embedding_dim=384):
+        """Creates the necessary tables, assuming embeddings are `embedding_dim` size.
+        An existing, unpartitioned Arxiv table is left as is (see
+        migrate_arxiv_to_partitioned)."""
+        q = self._arxiv_table_queries(embedding_dim)
 
         # Tweet Table Query
         q.append(
@@ -236,10 +387,111 @@ class Database:
         """
         )
 
+        # Tweet Embed Table Query (cache of rendered oEmbed HTML)
+        q.append(
+            f"""
+        CREATE TABLE IF NOT EXISTS {Tables.TWEET_EMBED} (
+            tweet_id VARCHAR(20),
+            html TEXT,
+            fetched_at TIMESTAMP,
+
+            PRIMARY KEY (tweet_id)
+        );
+        """
+        )
+
         with self._pool_conn() as connection:
             conn = connection.connection
             for t in q:
                 conn.execute(t)
+            if self._is_partitioned(conn, Tables.ARXIV):
+                # Holds arxiv IDs without a month prefix (pre-2007 IDs).
+                conn.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {Tables.ARXIV}_default
+                    PARTITION OF {Tables.ARXIV} DEFAULT
+                    """
+                )
+            conn.commit()
+
+    @staticmethod
+    def _is_partitioned(conn, table):
+        """Whether `table` is partitioned. `conn` may also be a cursor."""
+        return conn.execute(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass
+            )
+            """,
+            (table.value,),
+        ).fetchone()[0]
+
+    def _create_arxiv_partitions(self, cursor, source_table):
+        """Creates the Arxiv partitions (one per month) needed by the arxiv IDs in
+        `source_table`. They must exist before the rows are inserted, since a
+        partition can't be added while the default partition holds rows for it."""
+        cursor.execute(
+            f"""
+            SELECT DISTINCT left(arxiv_id, 4) FROM {source_table}
+            WHERE arxiv_id ~ '^[0-9]{{4}}[.]'
+            """
+        )
+        for (month,) in cursor.fetchall():
+            cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {Tables.ARXIV}_{month}
+                PARTITION OF {Tables.ARXIV}
+                FOR VALUES FROM ('{month}') TO ('{arxiv_id_month(month, 1)}')
+                """
+            )
+
+    def migrate_arxiv_to_partitioned(self, embedding_dim=384):
+        """Moves the rows of an unpartitioned Arxiv table (created before partitioning
+        was introduced) into a partitioned one, and points the foreign keys of the
+        other tables at it. Runs in a single transaction that locks the Arxiv table.
+        """
+        old_table = f"{Tables.ARXIV}_unpartitioned"
+        with self._pool_conn() as connection:
+            conn = connection.connection
+            if self._is_partitioned(conn, Tables.ARXIV):
+                logging.info("The Arxiv table is already partitioned.")
+                return
+            columns = self.get_table_columns(Tables.ARXIV)
+            with conn.cursor() as cur:
+                cur.execute(f"ALTER TABLE {Tables.ARXIV} RENAME TO {old_table}")
+                # Constraint and index names must be unique, so free them up.
+                cur.execute(
+                    f"""
+                    ALTER TABLE {old_table}
+                        RENAME CONSTRAINT {Tables.ARXIV.value.lower()}_pkey
+                        TO {old_table.lower()}_pkey;
+                    DROP INDEX IF EXISTS text_search_idx, popularity_idx, published_ts_idx
+                    """
+                )
+                for t in self._arxiv_table_queries(embedding_dim):
+                    cur.execute(t)
+                cur.execute(
+                    f"""
+                    CREATE TABLE {Tables.ARXIV}_default
+                    PARTITION OF {Tables.ARXIV} DEFAULT
+                    """
+                )
+                self._create_arxiv_partitions(cur, old_table)
+                cur.execute(
+                    f"""
+                    INSERT INTO {Tables.ARXIV} ({','.join(columns)})
+                    SELECT {','.join(columns)} FROM {old_table}
+                    """
+                )
+                for table, constraint in ARXIV_FOREIGN_KEYS:
+                    cur.execute(
+                        f"""
+                        ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint};
+                        ALTER TABLE {table} ADD CONSTRAINT {constraint}
+                            FOREIGN KEY (arxiv_id) REFERENCES {Tables.ARXIV}(arxiv_id)
+                        """
+                    )
+                cur.execute(f"DROP TABLE {old_table}")
             conn.commit()
 
     def delete_tables(self):
@@ -255,18 +507,21 @@ class Database:
         but caches the result.
         """
         if table not in self._table_columns:
-            generated_cols = GENERATED_COLUMNS.get(table, set())
             with self._pool_conn() as connection:
                 conn = connection.connection
                 with conn.cursor() as cur:
                     cur.execute(f"SELECT * FROM {table} LIMIT 0")
-                    self._table_columns[table] = [
-                        desc[0]
-                        for desc in cur.description
-                        if desc[0] not in generated_cols
-                    ]
+                    self._set_table_columns(table, cur.description)
         return self._table_columns[table][:]
 
+    def _set_table_columns(self, table: Tables, description):
+        """Caches the columns of `table` from the cursor `description` of a query
+        selecting all of them."""
+        generated_cols = GENERATED_COLUMNS.get(table, set())
+        self._table_columns[table] = [
+            desc[0] for desc in description if desc[0] not in generated_cols
+        ]
+
     def _format_record_to_tuple(self, record, cols):
         return tuple([record.get(c) for c in cols])
 
@@ -293,6 +548,7 @@ class Database:
         cursor,
         insert_cols=None,
         overwrite=True,
+        binary_types=None,
     ):
         """Performs a bulk insert of rows into the database. The rows are uploaded to a
         temp table, and then inserted into the existing table. If a row with the same
@@ -309,6 +565,9 @@ class Database:
             insert_cols: Columns to insert.
             overwrite: Whether to overwrite conflicting rows (upsert vs. insert)
             cursor: Database connection cursor to use.
+            binary_types: Optional dict of Postgres type name for each inserted column
+                (including primary keys). If given, rows are uploaded with a binary COPY,
+                which avoids converting values such as embeddings to and from text.
         """
         id_cols = PRIMARY_KEYS[table]
         temp_table_id = f"{table}_tmp_{str(uuid.uuid4())[:6]}"
@@ -326,11 +585,17 @@ class Database:
             AS SELECT {insert_cols_str} FROM {table} LIMIT 0
             """
         )
-        with cur.copy(f"COPY {temp_table_id} FROM STDIN") as copy:
+        copy_format = "(FORMAT BINARY)" if binary_types else ""
+        with cur.copy(f"COPY {temp_table_id} FROM STDIN {copy_format}") as copy:
+            if binary_types:
+                copy.set_types([binary_types[c] for c in insert_cols])
             for record in records:
                 record = self._format_record_to_tuple(record, insert_cols)
                 copy.write_row(record)
 
+        if table == Tables.ARXIV and self._is_partitioned(cur, table):
+            self._create_arxiv_partitions(cur, temp_table_id)
+
         if overwrite:
             # Update inserted columns, leave others alone
             update_set = ",".join(
@@ -353,6 +618,10 @@ class Database:
 
         Args:
             tweets: Tweets to insert.
+
+        Returns:
+            The set of arxiv IDs referenced by `tweets`, whose social metrics may have
+            changed.
         """
 
         def tweets_to_insert():
@@ -413,8 +682,20 @@ class Database:
                     cursor=cur,
                 )
             conn.commit()
+        return {i for t in tweets for i in t.arxiv_ids}
 
     def insert_hnews(self, posts: List[hnews.HNewsPost]):
+        """Inserts Hacker News posts into the database. Creates blank entries in Arxiv
+        table if necessary and creates entries in the ArxivHNews table.
+
+        Args:
+            posts: Posts to insert.
+
+        Returns:
+            The set of arxiv IDs referenced by `posts`, whose social metrics may have
+            changed.
+        """
+
         def posts_to_insert():
             for t in posts:
                 yield {
@@ -462,6 +743,7 @@ class Database:
                     cursor=cur,
                 )
             conn.commit()
+        return {i for t in posts for i in t.arxiv_ids}
 
     def insert_papers(self, papers: List[arxiv.ArxivPaper], insert_type=None):
         """Inserts papers into the database. Also updates author and category tables.
@@ -473,10 +755,12 @@ class Database:
         """
         if not len(papers):
             return
+        binary_types = None
         if insert_type is None:
             insert_cols = ["arxiv_id", "abstract", "title", "published_ts", "embedding"]
         elif insert_type == "embeddings":
             insert_cols = ["embedding"]
+            binary_types = {"arxiv_id": "varchar", "embedding": "vector"}
         elif insert_type == "summary":
             insert_cols = ["summary"]
         else:
@@ -490,8 +774,8 @@ class Database:
                     "title": p.title,
                     "published_ts": p.published,  # util.datetime_to_iso(p.published),
                     "embedding": (
-                        json.dumps(p.embedding, separators=(",", ":"))
-                        if p.embedding
+                        np.asarray(p.embedding, dtype=np.float32)
+                        if p.embedding is not None and len(p.embedding)
                         else None
                     ),
                     "summary": p.summary,
@@ -519,6 +803,7 @@ class Database:
                     overwrite=True,
                     cursor=cur,
                     insert_cols=insert_cols,
+                    binary_types=binary_types,
                 )
 
                 # Insert into authors table
@@ -541,12 +826,19 @@ class Database:
     def _list_index_map(self, lst):
         return {c: i for i, c in enumerate(lst)}
 
-    def _row_to_arxiv_entity(self, row, col_idx) -> ArxivEntity:
-        paper = arxiv.ArxivPaper(
+    def _row_to_arxiv_entity(self, row, col_idx, validate=True) -> ArxivEntity:
+        """Builds an ArxivEntity from a row of the Arxiv table. Rows come from Postgres
+        with the right types already, so `validate=False` skips pydantic's validation,
+        which dominates the cost for large result sets."""
+
+        def get(col):
+            return row[col_idx[col]] if col in col_idx else None
+
+        paper = (arxiv.ArxivPaper if validate else arxiv.ArxivPaper.construct)(
             arxiv_id=row[col_idx["arxiv_id"]],
-            title=row[col_idx["title"]],
-            abstract=row[col_idx["abstract"]],
-            published=row[col_idx["published_ts"]],
+            title=get("title"),
+            abstract=get("abstract"),
+            published=get("published_ts"),
         )
         if "embedding" in col_idx:
             paper.embedding = row[col_idx["embedding"]]
@@ -562,9 +854,36 @@ class Database:
                 prefix_col = f"{prefix}_{col}"
                 if prefix_col in col_idx:
                     final[col] = row[col_idx[prefix_col]]
+        if "popularity" in col_idx:
+            final["popularity"] = row[col_idx["popularity"]]
         final["paper"] = paper
+        if not validate:
+            return ArxivEntity.construct(**final)
         return ArxivEntity.parse_obj(final)
 
+    def _paper_filter_conditions(self, filters: Optional[PaperFilters]):
+        """Returns (conditions, args) for a WHERE clause implementing `filters`."""
+        conditions, args = [], []
+        if filters is None:
+            return conditions, args
+        if filters.required_null_fields:
+            columns = self.get_table_columns(Tables.ARXIV)
+            for field in filters.required_null_fields:
+                # Column names can't be bound, so only accept known ones.
+                if field not in columns:
+                    raise ValueError(f"Unknown column: {field}")
+                conditions.append(f"{field} IS NULL")
+        if filters.arxiv_ids is not None:
+            conditions.append("arxiv_id = ANY(%s)")
+            args.append(list(filters.arxiv_ids))
+        if filters.start_date is not None:
+            conditions.append("published_ts >= %s")
+            args.append(filters.start_date)
+        if filters.end_date is not None:
+            conditions.append("published_ts <= %s")
+            args.append(filters.end_date)
+        return conditions, args
+
     def get_papers(
         self,
         arxiv_ids=None,
@@ -573,7 +892,8 @@ class Database:
         required_null_fields=None,
         limit=None,
     ):
-        """Queries the database for papers and returns the results.
+        """Queries the database for papers and returns the results. Use iter_papers
+        instead for large result sets.
 
         Args:
             arxiv_ids: Which arxiv IDs to query. None to query all.
@@ -586,18 +906,15 @@ class Database:
         """
         if ids_only and include_embeddings:
             raise ValueError("Cant set ids_only and include_embeddings at same time")
-        results = []
-        where = ""
-        if required_null_fields:
-            where = "WHERE " + " AND ".join(
-                [f"{field} IS NULL" for field in required_null_fields]
-            )
-        if arxiv_ids:
-            where += " AND arxiv_id IN ({0})".format(
-                ",".join([f'"{arxiv_id}"' for arxiv_id in arxiv_ids])
+        conditions, args = self._paper_filter_conditions(
+            PaperFilters(
+                arxiv_ids=arxiv_ids or None, required_null_fields=required_null_fields
             )
+        )
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
         if limit:
-            where += f" ORDER BY published_ts DESC LIMIT {limit}"
+            where += " ORDER BY published_ts DESC LIMIT %s"
+            args.append(limit)
         if ids_only:
             select = ["arxiv_id"]
         else:
@@ -612,7 +929,8 @@ class Database:
                     f"""
                     SELECT {','.join(select)}
                     FROM {Tables.ARXIV}
-                    {where}"""
+                    {where}""",
+                    args,
                 )
                 if ids_only:
                     results = [row[0] for row in cur.fetchall()]
@@ -624,6 +942,116 @@ class Database:
                     ]
         return results
 
+    def get_embedding_matrix(self, chunk_size=2000):
+        """Returns (arxiv_ids, published_ts, embeddings) for every paper that has an
+        embedding, where `embeddings` is a float32 NumPy matrix with one row per paper.
+        """
+        q = f"""
+        SELECT arxiv_id, published_ts, embedding
+        FROM {Tables.ARXIV}
+        WHERE embedding IS NOT NULL
+        """
+        arxiv_ids = []
+        published_ts = []
+        chunks = []
+        with self._pool_conn() as connection:
+            conn = connection.connection
+            with conn.cursor(binary=True) as cur:
+                cur.execute(q)
+                while rows := cur.fetchmany(chunk_size):
+                    arxiv_ids.extend(row[0] for row in rows)
+                    published_ts.extend(row[1] for row in rows)
+                    chunks.append(np.stack([row[2] for row in rows]))
+        embeddings = np.concatenate(chunks) if chunks else np.zeros((0, 0), np.float32)
+        return arxiv_ids, published_ts, embeddings
+
+    def iter_papers(
+        self,
+        filters: Optional[PaperFilters] = None,
+        columns=None,
+        batch_size=1000,
+        keyset=False,
+    ):
+        """Yields papers one at a time, holding only `batch_size` rows in memory.
+
+        By default rows are streamed from a server-side cursor, which keeps a
+        transaction open until the iteration ends. With `keyset=True` each batch is a
+        separate query for the rows after the last one seen in (published_ts, arxiv_id)
+        order, so no transaction or connection is held between batches. Prefer it for
+        long iterations, e.g. ones that write to the table as they go.
+
+        Args:
+            filters: Which papers to return. None for all.
+            columns: Arxiv table columns to fetch. Defaults to all except the embedding.
+            batch_size: Number of rows fetched from the server per round trip.
+            keyset: Whether to page with keyset queries instead of a cursor.
+        """
+        if columns is None:
+            columns = self.get_table_columns(Tables.ARXIV)
+            columns.remove("embedding")
+        key_columns = ["published_ts", "arxiv_id"]
+        columns = list(set(columns).union(key_columns))
+        col_idx = self._list_index_map(columns)
+        conditions, args = self._paper_filter_conditions(filters)
+        if keyset:
+            yield from self._iter_papers_keyset(
+                columns, col_idx, conditions, args, batch_size
+            )
+            return
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        q = f"""
+        SELECT {','.join(columns)}
+        FROM {Tables.ARXIV}
+        {where}
+        """
+        with self._pool_conn() as connection:
+            conn = connection.connection
+            with conn.cursor(name=f"iter_papers_{str(uuid.uuid4())[:6]}") as cur:
+                cur.itersize = batch_size
+                cur.execute(q, args)
+                while rows := cur.fetchmany(batch_size):
+                    for row in rows:
+                        yield self._row_to_arxiv_entity(row, col_idx)
+            conn.commit()
+
+    def _iter_papers_keyset(self, columns, col_idx, conditions, args, batch_size):
+        # Papers whose details haven't been fetched yet have no published_ts. They
+        # are paged by arxiv_id alone, after the others.
+        passes = [
+            ("published_ts IS NOT NULL", ["published_ts", "arxiv_id"]),
+            ("published_ts IS NULL", ["arxiv_id"]),
+        ]
+        for condition, key_columns in passes:
+            last_key = None
+            while True:
+                page_conditions = conditions + [condition]
+                page_args = list(args)
+                if last_key is not None:
+                    page_conditions.append(
+                        "({0}) > ({1})".format(
+                            ",".join(key_columns), ",".join(["%s"] * len(key_columns))
+                        )
+                    )
+                    page_args.extend(last_key)
+                q = f"""
+                SELECT {','.join(columns)}
+                FROM {Tables.ARXIV}
+                WHERE {' AND '.join(page_conditions)}
+                ORDER BY {','.join(key_columns)}
+                LIMIT %s
+                """
+                with self._pool_conn() as connection:
+                    conn = connection.connection
+                    with conn.cursor() as cur:
+                        cur.execute(q, page_args + [batch_size])
+                        rows = cur.fetchall()
+                    conn.commit()
+                for row in rows:
+                    yield self._row_to_arxiv_entity(row, col_idx)
+                if len(rows) < batch_size:
+                    break
+                last_key = [rows[-1][col_idx[c]] for c in key_columns]
+
     def get_similar_papers(
         self,
         embeddings: Optional[List[List[float]]] = None,
@@ -633,6 +1061,12 @@ class Database:
         start_date=None,
         end_date=None,
         require_social=False,
+        candidates: Optional[Dict[str, float]] = None,
+        lexical_rank_query=None,
+        order_by="similarity",
+        aggregation="mean",
+        query_weights=None,
+        rescore=False,
     ) -> List[SimilarityResult]:
         """Returns papers with embeddings similar to `embedding` according to
         the dot product (same as cosine similarity given normalized embeddings).
@@ -645,23 +1079,90 @@ class Database:
             start_date: Earliest publication date.
             end_date: Latest publication date.
             require_social: Whether to require social engagements on results.
+            candidates: Precomputed similarities keyed by arxiv ID (e.g. from a
+                vector_index.VectorIndex). If given, only these papers are considered
+                and `embeddings` is ignored.
+            lexical_rank_query: If given, each result's `lexical_rank` is set to the
+                ts_rank of its title and abstract against this query.
+            order_by: "similarity", or "popularity" to return the most popular papers
+                regardless of similarity.
+            aggregation: How the similarities to several `embeddings` are combined
+                (see vector_index.AGGREGATIONS).
+            query_weights: Weight of each of `embeddings`, for the "weighted"
+                aggregation.
+            rescore: Whether to ignore the similarities in `candidates` and compute
+                them from `embeddings` instead (e.g. when they are approximate).
         """
-        cols = self.get_table_columns(Tables.ARXIV)
-        cols.remove("embedding")
-        col_idx = self._list_index_map(cols)
-
+        q, sql_args, cols = self._similar_papers_query(
+            embeddings=embeddings,
+            lexical_query=lexical_query,
+            exclude_query=exclude_query,
+            top_k=top_k,
+            start_date=start_date,
+            end_date=end_date,
+            require_social=require_social,
+            candidates=candidates,
+            lexical_rank_query=lexical_rank_query,
+            order_by=order_by,
+            aggregation=aggregation,
+            query_weights=query_weights,
+            rescore=rescore,
+        )
+        with self._pool_conn() as connection:
+            conn = connection.connection
+            with conn.cursor() as cur:
+                cur.execute(q, sql_args)
+                rows = cur.fetchall()
+        return self._rows_to_similarity_results(rows, cols, lexical_rank_query)
+
+    @staticmethod
+    def _similarity_clause(embeddings, aggregation="mean", query_weights=None):
+        """Returns (expression, args) for the aggregated similarity to `embeddings`."""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        weights = vector_index.linear_query_weights(
+            len(embeddings), aggregation, query_weights
+        )
+        if weights is not None:
+            # Stored embeddings are normalized, so a weighted mean of similarities is
+            # the (negated) inner product with the weighted mean of the queries.
+            return "(embedding <#> %s) * -1", [weights @ embeddings]
+        terms = ", ".join(["(1 - (embedding <=> %s))"] * len(embeddings))
+        function = "GREATEST" if aggregation == "max" else "LEAST"
+        return f"{function}({terms})", list(embeddings)
+
+    @staticmethod
+    def _similar_papers_filters(
+        start_date, end_date, require_social, lexical_query, exclude_query
+    ):
+        """Returns (conditions, args) of the filters shared by search queries."""
         where_clause = ["embedding IS NOT NULL"]
         sql_args = []
+        # Range predicates on the bare columns, so they can use indexes. The arxiv_id
+        # bounds let Postgres skip the Arxiv partitions (one per month of arxiv IDs)
+        # outside the date range, with a month of slack since an ID's month can
+        # differ from the publication date near month boundaries.
+        # No bound is used for dates outside the YYMM ID range (see
+        # arxiv_id_month_bound).
+        lower_id = None
         if start_date:
-            start_date = util.datetime_to_date_str(start_date)
-            where_clause.append(f"DATE(published_ts) >= '{start_date}'")
+            start_date = datetime(start_date.year, start_date.month, start_date.day)
+            where_clause.append("published_ts >= %s")
+            sql_args.append(start_date)
+            lower_id = arxiv_id_month_bound(start_date, -1)
+            if lower_id is not None:
+                where_clause.append("arxiv_id >= %s")
+                sql_args.append(lower_id)
         if end_date:
-            end_date = util.datetime_to_date_str(end_date)
-            where_clause.append(f"DATE(published_ts) <= '{end_date}'")
+            end_date = datetime(end_date.year, end_date.month, end_date.day)
+            where_clause.append("published_ts < %s")
+            sql_args.append(end_date + timedelta(days=1))
+            upper_id = arxiv_id_month_bound(end_date, 2)
+            # Older IDs have no month prefix and sort after every new style ID.
+            if lower_id is not None and upper_id is not None:
+                where_clause.append("arxiv_id < %s")
+                sql_args.append(upper_id)
         if require_social:
-            where_clause.append(
-                f"(tw_likes > 0 OR tw_retweets > 0 OR tw_quotes > 0 OR tw_replies > 0 OR hn_points > 0 OR hn_num_comments > 0)"
-            )
+            where_clause.append(SOCIAL_ENGAGEMENT_SQL)
         if lexical_query:
             where_clause.append(
                 f"text_search_vector @@ websearch_to_tsquery('english', %s)"
@@ -672,36 +1173,165 @@ class Database:
                 f"NOT (text_search_vector @@ websearch_to_tsquery('english', %s))"
             )
             sql_args.append(exclude_query)
+        return where_clause, sql_args
 
-        where_clause_str = "WHERE " + " AND ".join(where_clause)
-
+    def _lexical_candidates_query(
+        self,
+        query,
+        embeddings,
+        top_k,
+        start_date,
+        end_date,
+        require_social,
+        exclude_query,
+        aggregation="mean",
+        query_weights=None,
+    ):
+        """Builds the query for get_lexical_candidates. Returns (query, args)."""
+        where_clause, where_args = self._similar_papers_filters(
+            start_date, end_date, require_social, None, exclude_query
+        )
+        similarity_clause, select_args = "NULL::float8", []
         if embeddings is not None:
-            similarity_clause = []
-            for embedding in embeddings:
-                embedding = json.dumps(embedding, separators=(",", ":"))
-                similarity_clause.append(f"1 - (embedding <=> '{embedding}')")
-            similarity_clause = " + ".join(similarity_clause)
-            similarity_clause = f"({similarity_clause}) / {len(embeddings)}"
-        else:
-            similarity_clause = "0"
+            similarity_clause, select_args = self._similarity_clause(
+                embeddings, aggregation, query_weights
+            )
+        # Normalization 32 maps ranks to [0, 1).
         q = f"""
-        SELECT {','.join([c for c in cols])}, {similarity_clause} AS similarity
-        FROM {Tables.ARXIV}
-        {where_clause_str}
-        ORDER BY similarity DESC, published_ts DESC LIMIT {top_k}
+        SELECT arxiv_id, ts_rank_cd(text_search_vector, q, 32) AS lexical_rank,
+            {similarity_clause} AS similarity
+        FROM {Tables.ARXIV}, websearch_to_tsquery('english', %s) AS q
+        WHERE text_search_vector @@ q AND {' AND '.join(where_clause)}
+        ORDER BY lexical_rank DESC LIMIT %s
         """
-        results = []
+        return q, select_args + [query] + where_args + [top_k]
+
+    def get_lexical_candidates(
+        self,
+        query,
+        embeddings=None,
+        top_k=100,
+        start_date=None,
+        end_date=None,
+        require_social=False,
+        exclude_query=None,
+        aggregation="mean",
+        query_weights=None,
+    ):
+        """Retrieves the papers whose title and abstract best match `query`, ranked by
+        ts_rank_cd (which rewards query terms appearing close together).
+
+        Args:
+            query: Web search style query (see websearch_to_tsquery).
+            embeddings: If given, the similarity of each paper to these embeddings is
+                also returned, as in get_similar_papers.
+            top_k: Number of papers to return.
+            start_date, end_date, require_social, exclude_query: Filters, as in
+                get_similar_papers.
+            aggregation, query_weights: As in get_similar_papers.
+
+        Returns:
+            A list of (arxiv_id, lexical_rank, similarity) tuples, best match first.
+            `similarity` is None if no embeddings were given.
+        """
+        q, sql_args = self._lexical_candidates_query(
+            query,
+            embeddings,
+            top_k,
+            start_date,
+            end_date,
+            require_social,
+            exclude_query,
+            aggregation,
+            query_weights,
+        )
         with self._pool_conn() as connection:
             conn = connection.connection
             with conn.cursor() as cur:
                 cur.execute(q, sql_args)
-                for row in cur.fetchall():
-                    full_result = self._row_to_arxiv_entity(row, col_idx)
-                    results.append(
-                        SimilarityResult(entity=full_result, similarity=row[-1])
-                    )
+                return cur.fetchall()
 
-        return results
+    def _similar_papers_query(
+        self,
+        embeddings,
+        lexical_query,
+        exclude_query,
+        top_k,
+        start_date,
+        end_date,
+        require_social,
+        candidates,
+        lexical_rank_query,
+        order_by,
+        aggregation="mean",
+        query_weights=None,
+        rescore=False,
+    ):
+        """Builds the query for get_similar_papers. Returns (query, args, columns)."""
+        if order_by not in ("similarity", "popularity"):
+            raise ValueError(f"Invalid order_by '{order_by}'")
+        cols = self.get_table_columns(Tables.ARXIV)
+        cols.remove("embedding")
+        cols.append("popularity")
+
+        where_clause, sql_args = self._similar_papers_filters(
+            start_date, end_date, require_social, lexical_query, exclude_query
+        )
+        where_clause_str = "WHERE " + " AND ".join(where_clause)
+
+        # Query vectors are bound as parameters (see pgvector.register_vector) so the
+        # query text stays the same across searches and its plan can be cached.
+        select_args = []
+        from_args = []
+        from_clause = Tables.ARXIV
+        if candidates is not None and rescore and embeddings is not None:
+            from_clause = f"""{Tables.ARXIV}
+            INNER JOIN unnest(%s::text[]) AS c(arxiv_id) USING (arxiv_id)"""
+            from_args = [list(candidates.keys())]
+            similarity_clause, select_args = self._similarity_clause(
+                embeddings, aggregation, query_weights
+            )
+        elif candidates is not None:
+            from_clause = f"""{Tables.ARXIV}
+            INNER JOIN unnest(%s::text[], %s::float8[]) AS c(arxiv_id, similarity)
+            USING (arxiv_id)"""
+            from_args = [list(candidates.keys()), list(candidates.values())]
+            similarity_clause = "c.similarity"
+        elif embeddings is not None:
+            similarity_clause, select_args = self._similarity_clause(
+                embeddings, aggregation, query_weights
+            )
+        else:
+            similarity_clause = "0"
+        select_clause = (
+            f"{','.join([c for c in cols])}, {similarity_clause} AS similarity"
+        )
+        if lexical_rank_query:
+            select_clause += (
+                ", ts_rank(text_search_vector, websearch_to_tsquery('english', %s))"
+            )
+            select_args.append(lexical_rank_query)
+        q = f"""
+        SELECT {select_clause}
+        FROM {from_clause}
+        {where_clause_str}
+        ORDER BY {order_by} DESC, published_ts DESC LIMIT %s
+        """
+        sql_args = select_args + from_args + sql_args + [top_k]
+        return q, sql_args, cols
+
+    def _rows_to_similarity_results(
+        self, rows, cols, lexical_rank_query=None
+    ) -> List[SimilarityResult]:
+        col_idx = self._list_index_map(cols)
+        return [
+            SimilarityResult.construct(
+                entity=self._row_to_arxiv_entity(row, col_idx, validate=False),
+                similarity=row[len(cols)],
+                lexical_rank=row[len(cols) + 1] if lexical_rank_query else None,
+            )
+            for row in rows
+        ]
 
     def get_latest_tweet_dt(self):
         """Returns the creation date of the latest tweet in the database."""
@@ -715,15 +1345,31 @@ class Database:
                     return None
                 return res[0]
 
-    def update_arxiv_social_metrics(self, update_twitter=False, update_hnews=False):
+    def update_arxiv_social_metrics(
+        self, update_twitter=False, update_hnews=False, arxiv_ids=None
+    ):
+        """Recomputes the per-source social sums of papers in the Arxiv table. The
+        `popularity` column is generated from them by Postgres.
+
+        Args:
+            update_twitter: Whether to update Twitter metrics.
+            update_hnews: Whether to update Hacker News metrics.
+            arxiv_ids: Only update these papers (e.g. those returned by insert_tweets or
+                insert_hnews). None to update every paper.
+        """
         if not update_twitter and not update_hnews:
             raise ValueError("Must update either twitter or hacker news metrics.")
+        if arxiv_ids is not None:
+            arxiv_ids = list(arxiv_ids)
+            if not arxiv_ids:
+                return
         twitter_q = f"""
         SELECT at.arxiv_id,
         {','.join(['SUM(t.' + col + ') AS ' + col for col in TWITTER_SOCIAL_ARXIV_COLUMNS])}
         FROM {Tables.ARXIV_TWEET} at
         INNER JOIN {Tables.TWEET} t 
         ON at.tweet_id = t.tweet_id
+        {'WHERE at.arxiv_id = ANY(%s)' if arxiv_ids is not None else ''}
         GROUP BY at.arxiv_id
         """
         hnews_q = f"""
@@ -732,6 +1378,7 @@ class Database:
         FROM {Tables.ARXIV_HNEWS} ah
         INNER JOIN {Tables.HNEWS} h
         ON ah.hnews_id = h.hnews_id
+        {'WHERE ah.arxiv_id = ANY(%s)' if arxiv_ids is not None else ''}
         GROUP BY ah.arxiv_id
         """
 
@@ -745,7 +1392,7 @@ class Database:
             conn = connection.connection
             with conn.cursor() as cur:
                 for query, prefix, cols in updates:
-                    cur.execute(query)
+                    cur.execute(query, (arxiv_ids,) if arxiv_ids is not None else None)
                     results = cur.fetchall()
 
                     def papers_to_insert():
@@ -767,12 +1414,13 @@ class Database:
                     )
             conn.commit()
 
-    def get_arxiv_tweet_ids(self, arxiv_id):
-        q = f"""
+    ARXIV_TWEET_IDS_QUERY = f"""
         SELECT tweet_id FROM {Tables.ARXIV_TWEET}
         WHERE arxiv_id = %s
-        
         """
+
+    def get_arxiv_tweet_ids(self, arxiv_id):
+        q = self.ARXIV_TWEET_IDS_QUERY
         tweetIds = []
         with self._pool_conn() as connection:
             conn = connection.connection
@@ -782,17 +1430,109 @@ class Database:
                     tweetIds.append(row[0])
         return tweetIds
 
-    def get_arxiv_hnews_ids(self, arxiv_id):
-        # TODO: Make this function also get the points and comment counts.
-        # q = f"""
-        # SELECT ah.hnews_id FROM {Tables.ARXIV_HNEWS} ah
-        # INNER JOIN {Tables.HNEWS} hn ON ah.hnews_id = hn.hnews_id
-        # WHERE arxiv_id = %s
-        # """
-        q = f"""
+    # Engagement of a single tweet or HN item, weighted as in POPULARITY_SQL.
+    SOCIAL_QUERY = """
+        SELECT a.arxiv_id,
+            (
+                SELECT coalesce(json_agg(t ORDER BY t.engagement DESC), '[]')
+                FROM (
+                    SELECT tw.*, {tweet_engagement} AS engagement
+                    FROM {arxiv_tweet} atw
+                    INNER JOIN {tweet} tw USING (tweet_id)
+                    WHERE atw.arxiv_id = a.arxiv_id
+                ) t
+            ) AS tweets,
+            (
+                SELECT coalesce(json_agg(h ORDER BY h.engagement DESC), '[]')
+                FROM (
+                    SELECT hn.*, {hnews_engagement} AS engagement
+                    FROM {arxiv_hnews} ahn
+                    INNER JOIN {hnews} hn USING (hnews_id)
+                    WHERE ahn.arxiv_id = a.arxiv_id
+                ) h
+            ) AS hnews
+        FROM {arxiv} a
+        WHERE a.arxiv_id = ANY(%s)
+        """.format(
+        tweet_engagement=" + ".join(
+            f"{w} * coalesce(tw.{c[len('tw_'):]}, 0)"
+            for c, w in POPULARITY_WEIGHTS.items()
+            if c.startswith("tw_")
+        ),
+        hnews_engagement=" + ".join(
+            f"{w} * coalesce(hn.{c[len('hn_'):]}, 0)"
+            for c, w in POPULARITY_WEIGHTS.items()
+            if c.startswith("hn_")
+        ),
+        arxiv=Tables.ARXIV.value,
+        arxiv_tweet=Tables.ARXIV_TWEET.value,
+        tweet=Tables.TWEET.value,
+        arxiv_hnews=Tables.ARXIV_HNEWS.value,
+        hnews=Tables.HNEWS.value,
+    )
+
+    @staticmethod
+    def _rows_to_social(arxiv_ids, rows) -> Dict[str, PaperSocial]:
+        social = {a: PaperSocial(arxiv_id=a) for a in arxiv_ids}
+        for arxiv_id, tweets, hn_items in rows:
+            social[arxiv_id] = PaperSocial(
+                arxiv_id=arxiv_id, tweets=tweets, hnews=hn_items
+            )
+        return social
+
+    def get_social(self, arxiv_ids) -> Dict[str, PaperSocial]:
+        """Returns the tweets and Hacker News items of each paper, with their metrics,
+        in a single query. Papers without any are included with empty lists."""
+        arxiv_ids = list(arxiv_ids)
+        with self._pool_conn() as connection:
+            conn = connection.connection
+            with conn.cursor() as cur:
+                cur.execute(self.SOCIAL_QUERY, (arxiv_ids,))
+                rows = cur.fetchall()
+        return self._rows_to_social(arxiv_ids, rows)
+
+    TWEET_EMBEDS_QUERY = f"""
+        SELECT tweet_id, html FROM {Tables.TWEET_EMBED}
+        WHERE tweet_id = ANY(%s) AND fetched_at >= %s
+        """
+
+    def get_tweet_embeds(self, tweet_ids, max_age=timedelta(days=30)) -> Dict[str, str]:
+        """Returns the cached embedded HTML of each tweet keyed by tweet ID, leaving out
+        tweets that aren't cached or were fetched more than `max_age` ago."""
+        with self._pool_conn() as connection:
+            conn = connection.connection
+            with conn.cursor() as cur:
+                cur.execute(
+                    self.TWEET_EMBEDS_QUERY,
+                    ([str(t) for t in tweet_ids], datetime.utcnow() - max_age),
+                )
+                return dict(cur.fetchall())
+
+    def insert_tweet_embeds(self, htmls: Dict[str, str]):
+        """Caches the embedded HTML of tweets, keyed by tweet ID."""
+        fetched_at = datetime.utcnow()
+        with self._pool_conn() as connection:
+            conn = connection.connection
+            with conn.cursor() as cur:
+                self._bulk_insert(
+                    table=Tables.TWEET_EMBED,
+                    records=(
+                        {"tweet_id": t, "html": html, "fetched_at": fetched_at}
+                        for t, html in htmls.items()
+                    ),
+                    overwrite=True,
+                    cursor=cur,
+                )
+            conn.commit()
+
+    ARXIV_HNEWS_IDS_QUERY = f"""
         SELECT hnews_id FROM {Tables.ARXIV_HNEWS}
         WHERE arxiv_id = %s
         """
+
+    def get_arxiv_hnews_ids(self, arxiv_id):
+        # Use get_social for the points and comment counts.
+        q = self.ARXIV_HNEWS_IDS_QUERY
         hnews_ids = []
         with self._pool_conn() as connection:
             conn = connection.connection
@@ -801,3 +1541,170 @@ class Database:
                 for row in cur.fetchall():
                     hnews_ids.append(row[0])
         return hnews_ids
+
+
+class AsyncDatabase:
+    """Async versions of the Database queries used by the web endpoints. Queries run on
+    a psycopg AsyncConnectionPool, so they don't block the event loop.
+    Call `open` before use (e.g. on app startup) and `close` when done.
+    """
+
+    def __init__(self, db: Database, min_size=1, max_size=10):
+        """
+        Args:
+            db: Database used to build queries and parse their results.
+            min_size: Minimum number of pooled connections.
+            max_size: Maximum number of pooled connections.
+        """
+        self._db = db
+        self._pool = AsyncConnectionPool(
+            db._conninfo,
+            min_size=min_size,
+            max_size=max_size,
+            max_idle=4 * 60,
+            open=False,
+            configure=self._configure,
+            check=AsyncConnectionPool.check_connection,
+        )
+
+    @staticmethod
+    async def _configure(conn):
+        await pgvector.register_vector_async(conn)
+        await conn.commit()
+
+    async def open(self):
+        await self._pool.open()
+
+    async def close(self):
+        await self._pool.close()
+
+    async def _load_table_columns(self, table: Tables):
+        """Fills the Database column cache of `table` on the pool, so that building
+        queries doesn't make Database open a blocking connection."""
+        if table in self._db._table_columns:
+            return
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(f"SELECT * FROM {table} LIMIT 0")
+                self._db._set_table_columns(table, cur.description)
+
+    async def _fetchall(self, q, args):
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(q, args)
+                return await cur.fetchall()
+
+    async def get_similar_papers(
+        self,
+        embeddings: Optional[List[List[float]]] = None,
+        lexical_query=None,
+        exclude_query=None,
+        top_k=10,
+        start_date=None,
+        end_date=None,
+        require_social=False,
+        candidates: Optional[Dict[str, float]] = None,
+        lexical_rank_query=None,
+        order_by="similarity",
+        aggregation="mean",
+        query_weights=None,
+        rescore=False,
+    ) -> List[SimilarityResult]:
+        """See Database.get_similar_papers."""
+        await self._load_table_columns(Tables.ARXIV)
+        q, sql_args, cols = self._db._similar_papers_query(
+            embeddings=embeddings,
+            lexical_query=lexical_query,
+            exclude_query=exclude_query,
+            top_k=top_k,
+            start_date=start_date,
+            end_date=end_date,
+            require_social=require_social,
+            candidates=candidates,
+            lexical_rank_query=lexical_rank_query,
+            order_by=order_by,
+            aggregation=aggregation,
+            query_weights=query_weights,
+            rescore=rescore,
+        )
+        rows = await self._fetchall(q, sql_args)
+        return self._db._rows_to_similarity_results(rows, cols, lexical_rank_query)
+
+    async def get_lexical_candidates(
+        self,
+        query,
+        embeddings=None,
+        top_k=100,
+        start_date=None,
+        end_date=None,
+        require_social=False,
+        exclude_query=None,
+        aggregation="mean",
+        query_weights=None,
+        timeout_ms=None,
+    ):
+        """See Database.get_lexical_candidates. If the query runs for longer than
+        `timeout_ms`, Postgres cancels it and asyncio.TimeoutError is raised."""
+        q, sql_args = self._db._lexical_candidates_query(
+            query,
+            embeddings,
+            top_k,
+            start_date,
+            end_date,
+            require_social,
+            exclude_query,
+            aggregation,
+            query_weights,
+        )
+        async with self._pool.connection() as conn:
+            try:
+                async with conn.transaction():
+                    async with conn.cursor() as cur:
+                        if timeout_ms is not None:
+                            await cur.execute(
+                                "SELECT set_config('statement_timeout', %s, true)",
+                                (str(int(timeout_ms)),),
+                            )
+                        await cur.execute(q, sql_args)
+                        return await cur.fetchall()
+            except psycopg.errors.QueryCanceled as ex:
+                raise asyncio.TimeoutError() from ex
+
+    async def get_arxiv_tweet_ids(self, arxiv_id):
+        rows = await self._fetchall(Database.ARXIV_TWEET_IDS_QUERY, (arxiv_id,))
+        return [row[0] for row in rows]
+
+    async def get_social(self, arxiv_ids) -> Dict[str, PaperSocial]:
+        """See Database.get_social."""
+        arxiv_ids = list(arxiv_ids)
+        rows = await self._fetchall(Database.SOCIAL_QUERY, (arxiv_ids,))
+        return Database._rows_to_social(arxiv_ids, rows)
+
+    async def get_tweet_embeds(
+        self, tweet_ids, max_age=timedelta(days=30)
+    ) -> Dict[str, str]:
+        """See Database.get_tweet_embeds."""
+        rows = await self._fetchall(
+            Database.TWEET_EMBEDS_QUERY,
+            ([str(t) for t in tweet_ids], datetime.utcnow() - max_age),
+        )
+        return dict(rows)
+
+    async def insert_tweet_embeds(self, htmls: Dict[str, str]):
+        """See Database.insert_tweet_embeds."""
+        fetched_at = datetime.utcnow()
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(
+                    f"""
+                    INSERT INTO {Tables.TWEET_EMBED} (tweet_id, html, fetched_at)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (tweet_id)
+                    DO UPDATE SET html = excluded.html, fetched_at = excluded.fetched_at
+                    """,
+                    [(t, html, fetched_at) for t, html in htmls.items()],
+                )
+
+    async def get_arxiv_hnews_ids(self, arxiv_id):
+        rows = await self._fetchall(Database.ARXIV_HNEWS_IDS_QUERY, (arxiv_id,))
+        return [row[0] for row in rows]
@@ -1,4 +1,5 @@
 from transformers import AutoTokenizer, AutoModel
+import numpy as np
 import torch
 import torch.nn.functional as F
 import os
@@ -6,13 +7,107 @@ from lib import util
 
 import logging
 
+# Ways of running the model's forward pass:
+#   torch: The fp32 HuggingFace model.
+#   torch_int8: The model with its linear layers dynamically quantized to int8.
+#   onnx: The fp32 model exported to ONNX and run with ONNX Runtime (needs the
+#       onnxruntime package).
+BACKENDS = ("torch", "torch_int8", "onnx")
+
+# Graph inputs of exported ONNX models, in order.
+ONNX_INPUTS = ("input_ids", "attention_mask", "token_type_ids")
+
+
+class _TokenEmbeddings(torch.nn.Module):
+    """Wraps a HuggingFace model to take its inputs positionally, in ONNX_INPUTS order,
+    and return only the token embeddings, for ONNX export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+        )[0]
+
 
 class SentenceTransformer:
-    def __init__(self, model="sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(
+        self,
+        model="sentence-transformers/all-MiniLM-L6-v2",
+        num_threads=None,
+        backend=None,
+    ):
+        """
+        Args:
+            model: HuggingFace model name.
+            num_threads: Number of intra-op threads torch uses for inference. Defaults
+                to the TORCH_NUM_THREADS environment variable, or torch's own default
+                (one per physical core) if that is unset.
+            backend: One of BACKENDS. Defaults to the EMBEDDING_BACKEND environment
+                variable, or "torch" if that is unset.
+        """
+        backend = backend or util.get_env_var("EMBEDDING_BACKEND", "torch")
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid embedding backend '{backend}'")
+        self.backend = backend
         cache_dir = util.get_env_var("TORCH_HOME", must_exist=True)
         logging.info(f"Using pytorch cache directory: {cache_dir}")
         self._tokenizer = AutoTokenizer.from_pretrained(model, cache_dir=cache_dir)
         self._model = AutoModel.from_pretrained(model, cache_dir=cache_dir)
+        self._model.eval()
+        num_threads = num_threads or util.get_env_var("TORCH_NUM_THREADS")
+        if num_threads:
+            torch.set_num_threads(int(num_threads))
+        self._session = None
+        if backend == "torch_int8":
+            self._model = torch.ao.quantization.quantize_dynamic(
+                self._model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        elif backend == "onnx":
+            self._session = self._onnx_session(model, cache_dir, num_threads)
+        logging.info(f"Using {backend} embedding backend.")
+
+    def _onnx_session(self, model, cache_dir, num_threads=None):
+        """Exports the model to ONNX (once, under `cache_dir`) and loads it into an ONNX
+        Runtime session."""
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                "The onnx embedding backend needs onnxruntime (pip install onnxruntime)"
+            )
+        path = os.path.join(cache_dir, "onnx", f"{model.replace('/', '__')}.onnx")
+        if not os.path.exists(path):
+            logging.info(f"Exporting {model} to {path}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            dummy = self._tokenizer(["export"], return_tensors="pt")
+            axes = {0: "batch", 1: "sequence"}
+            names = ONNX_INPUTS + ("token_embeddings",)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.onnx.export(
+                _TokenEmbeddings(self._model),
+                tuple(dummy[name] for name in ONNX_INPUTS),
+                tmp_path,
+                input_names=list(ONNX_INPUTS),
+                output_names=["token_embeddings"],
+                dynamic_axes={name: axes for name in names},
+                opset_version=14,
+            )
+            os.replace(tmp_path, path)
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = int(num_threads)
+        return onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    @property
+    def dim(self):
+        return self._model.config.hidden_size
 
     @staticmethod
     def _mean_pooling(model_output, attention_mask):
@@ -26,6 +121,18 @@ class SentenceTransformer:
             input_mask_expanded.sum(1), min=1e-9
         )
 
+    def _forward(self, encoded_input):
+        """Returns the normalized embeddings of a tokenized batch as a float32 array."""
+        if self._session is not None:
+            feeds = {name: encoded_input[name].numpy() for name in ONNX_INPUTS}
+            model_output = (torch.from_numpy(self._session.run(None, feeds)[0]),)
+        else:
+            model_output = self._model(**encoded_input)
+        sentence_embeddings = self._mean_pooling(
+            model_output, encoded_input["attention_mask"]
+        )
+        return F.normalize(sentence_embeddings, p=2, dim=1).numpy()
+
     def embed(self, sentences):
         if not len(sentences):
             return []
@@ -33,13 +140,51 @@ class SentenceTransformer:
             sentences, padding=True, truncation=True, return_tensors="pt"
         )
         with torch.no_grad():
-            model_output = self._model(**encoded_input)
-        sentence_embeddings = self._mean_pooling(
-            model_output, encoded_input["attention_mask"]
-        )
-        sentence_embeddings = F.normalize(sentence_embeddings, p=2, dim=1)
+            sentence_embeddings = self._forward(encoded_input)
         return [x.tolist() for x in sentence_embeddings]
 
+    def embed_many(self, texts, max_tokens_per_batch=8192, max_batch_size=256):
+        """Embeds a large number of texts efficiently. Texts are sorted by token length
+        and packed into batches of similar lengths, so little compute is spent on
+        padding.
+
+        Args:
+            texts: Texts to embed.
+            max_tokens_per_batch: Maximum number of (padded) tokens in a batch.
+            max_batch_size: Maximum number of texts in a batch.
+
+        Returns:
+            A contiguous float32 array of shape (len(texts), dim), in the order of `texts`.
+        """
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+        if not len(texts):
+            return result
+        encoded = self._tokenizer(list(texts), truncation=True)
+        lengths = np.array([len(ids) for ids in encoded["input_ids"]])
+        order = np.argsort(lengths, kind="stable")
+
+        def run_batch(batch):
+            features = self._tokenizer.pad(
+                {k: [encoded[k][i] for i in batch] for k in encoded.keys()},
+                padding=True,
+                return_tensors="pt",
+            )
+            result[batch] = self._forward(features)
+
+        batch = []
+        with torch.inference_mode():
+            for i in order:
+                # Lengths are increasing, so text i sets the padded length of the batch.
+                if batch and (
+                    (len(batch) + 1) * lengths[i] > max_tokens_per_batch
+                    or len(batch) == max_batch_size
+                ):
+                    run_batch(batch)
+                    batch = []
+                batch.append(i)
+            run_batch(batch)
+        return result
+
     # def embed_batch(self, sentences, batch_size=16):
     #     results = []
     #     for i in range(0, len(sentences), batch_size):
@@ -5,7 +5,6 @@ from lib import arxiv, util
 from typing import List, Optional
 from datetime import datetime, timezone
 import pydantic
-from html2text import html2text
 import time
 import logging
 
@@ -29,6 +28,9 @@ def _get_or_else(d, key, default=""):
 
 
 def search_for_arxiv(start_time=None, end_time=None, num_results=10, order_by="date"):
+    # Only used by the pipeline, so imported here to keep web startup fast.
+    from html2text import html2text
+
     if order_by == "date":
         search_url = DATE_SEARCH_URL
     elif order_by == "popularity":
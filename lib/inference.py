@@ -0,0 +1,113 @@
+from concurrent import futures
+import logging
+import os
+import queue
+import threading
+import time
+
+# Upper bounds of the batch size histogram buckets.
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, float("inf"))
+
+
+class BatchingEmbedder:
+    """Embeds texts from concurrent callers on a single worker thread. The worker
+    gathers queued requests for up to `max_wait_ms` (or until `max_batch_size` texts
+    are queued) and runs them through the model in one forward pass.
+    """
+
+    def __init__(self, model, max_wait_ms=5, max_batch_size=64):
+        """
+        Args:
+            model: An embedding.SentenceTransformer.
+            max_wait_ms: Maximum time the first request of a batch waits for others.
+            max_batch_size: Maximum number of texts per forward pass.
+        """
+        self._model = model
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.num_batches = 0
+        self.num_texts = 0
+        self.max_queue_depth = 0
+        self.batch_size_histogram = {b: 0 for b in BATCH_SIZE_BUCKETS}
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so (re)start the worker in each process.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._run, name="batching-embedder", daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, texts) -> futures.Future:
+        """Queues `texts` for embedding. The returned future resolves to a float32
+        array with one row per text."""
+        self._ensure_started()
+        future = futures.Future()
+        self._queue.put((list(texts), future))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        num_texts = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while num_texts < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            num_texts += len(item[0])
+        return batch
+
+    def _record_batch(self, num_texts):
+        self.num_batches += 1
+        self.num_texts += num_texts
+        for bucket in BATCH_SIZE_BUCKETS:
+            if num_texts <= bucket:
+                self.batch_size_histogram[bucket] += 1
+                return
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = [t for item_texts, _ in batch for t in item_texts]
+            self._record_batch(len(texts))
+            try:
+                embeddings = self._model.embed_many(
+                    texts, max_batch_size=self.max_batch_size
+                )
+            except Exception as ex:
+                logging.error(f"Embedding batch failed: {ex}")
+                for _, future in batch:
+                    future.set_exception(ex)
+                continue
+            i = 0
+            for item_texts, future in batch:
+                future.set_result(embeddings[i : i + len(item_texts)])
+                i += len(item_texts)
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "num_batches": self.num_batches,
+            "mean_batch_size": (
+                self.num_texts / self.num_batches if self.num_batches else None
+            ),
+            "batch_size_histogram": {
+                f"<={b}": n for b, n in self.batch_size_histogram.items()
+            },
+        }
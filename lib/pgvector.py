@@ -0,0 +1,74 @@
+"""psycopg adapters for the pgvector `vector` type, so NumPy arrays can be written and
+read directly in both the text and binary protocols."""
+import logging
+import struct
+
+import numpy as np
+from psycopg.adapt import Dumper, Loader
+from psycopg.pq import Format
+from psycopg.types import TypeInfo
+
+
+class VectorDumper(Dumper):
+    format = Format.TEXT
+
+    def dump(self, obj):
+        values = np.asarray(obj, dtype=np.float32).tolist()
+        return ("[" + ",".join(map(str, values)) + "]").encode()
+
+
+class VectorBinaryDumper(VectorDumper):
+    format = Format.BINARY
+
+    def dump(self, obj):
+        # Binary layout: uint16 dim, uint16 unused, then big-endian float32 values.
+        values = np.asarray(obj, dtype=">f4")
+        return struct.pack(">HH", values.shape[0], 0) + values.tobytes()
+
+
+class VectorLoader(Loader):
+    format = Format.TEXT
+
+    def load(self, data):
+        text = bytes(data).decode()
+        return np.array(text[1:-1].split(","), dtype=np.float32)
+
+
+class VectorBinaryLoader(Loader):
+    format = Format.BINARY
+
+    def load(self, data):
+        dim, _ = struct.unpack_from(">HH", data)
+        return np.frombuffer(data, dtype=">f4", count=dim, offset=4).astype(np.float32)
+
+
+def _register(context, info):
+    info.register(context)
+    adapters = context.adapters
+    # Dumpers need the oid of `vector`, which differs between databases.
+    for base in (VectorDumper, VectorBinaryDumper):
+        adapters.register_dumper(
+            np.ndarray, type(base.__name__, (base,), {"oid": info.oid})
+        )
+    adapters.register_loader(info.oid, VectorLoader)
+    adapters.register_loader(info.oid, VectorBinaryLoader)
+
+
+def register_vector(conn):
+    """Registers the vector adapters on a psycopg connection. NumPy arrays passed as
+    query parameters or COPY values are then sent as vectors, and vector columns are
+    returned as float32 NumPy arrays."""
+    info = TypeInfo.fetch(conn, "vector")
+    if info is None:
+        logging.warning("The vector type was not found. Is pgvector installed?")
+        return
+    _register(conn, info)
+
+
+async def register_vector_async(conn):
+    """Same as register_vector, for a psycopg AsyncConnection."""
+    info = await TypeInfo.fetch(conn, "vector")
+    if info is None:
+        logging.warning("The vector type was not found. Is pgvector installed?")
+        return
+    _register(conn, info)
@@ -0,0 +1,151 @@
+from lib import database
+import numpy as np
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+import pydantic
+
+# Recency scores halve every this many seconds (3 months).
+RECENCY_HALF_LIFE_SECONDS = 3 * 30 * 24 * 3600
+
+_EPSILON = 1e-6
+
+
+class RankingWeights(pydantic.BaseModel):
+    """Importance of each ranking signal, on the same 0-100 scale as the UI sliders."""
+
+    semantic: float = 100
+    lexical: float = 0
+    popularity: float = 25
+    recency: float = 0
+
+
+def popularity_scores(entities: List[database.ArxivEntity]) -> np.ndarray:
+    """Log-scaled engagement of each entity across Twitter and Hacker News. Uses the
+    precomputed `popularity` column when it was fetched."""
+    if all(e.popularity is not None for e in entities):
+        return np.array([e.popularity for e in entities], dtype=np.float64)
+    counts = np.array(
+        [
+            [
+                e.likes or 0,
+                e.retweets or 0,
+                e.replies or 0,
+                e.quotes or 0,
+                e.impressions or 0,
+                e.points or 0,
+                e.num_comments or 0,
+            ]
+            for e in entities
+        ],
+        dtype=np.float64,
+    ).reshape(-1, 7)
+    # Same column order as database.POPULARITY_WEIGHTS
+    weights = np.array(list(database.POPULARITY_WEIGHTS.values()), dtype=np.float64)
+    return np.log1p(counts @ weights)
+
+
+def recency_scores(published: List[Optional[datetime]]) -> np.ndarray:
+    """Exponentially decayed age of each paper relative to the newest one."""
+    ts = np.array(
+        [p.timestamp() if p is not None else np.nan for p in published],
+        dtype=np.float64,
+    )
+    if not len(ts) or np.isnan(ts).all():
+        return np.zeros(len(ts))
+    age = np.nanmax(ts) - ts
+    return np.nan_to_num(np.power(0.5, age / RECENCY_HALF_LIFE_SECONDS))
+
+
+def _normalized(scores: np.ndarray) -> np.ndarray:
+    if not len(scores):
+        return scores
+    return scores / (_EPSILON + scores.max())
+
+
+def rank_results(
+    results: List[database.SimilarityResult],
+    weights: RankingWeights,
+    top_k: Optional[int] = None,
+    fused=False,
+) -> List[database.SimilarityResult]:
+    """Blends semantic similarity, lexical rank, popularity and recency into a single
+    score per result and returns the `top_k` best results. Each signal is normalized by
+    its maximum over `results` before weighting. Sets `score` on the returned results.
+
+    Args:
+        results: Candidate results. `lexical_rank` is only needed if weights.lexical > 0.
+        weights: Ranking weights.
+        top_k: Number of results to return. Defaults to all of them.
+        fused: Whether `score` already holds a fusion of similarity and lexical rank
+            (see reciprocal_rank_fusion), weighted by weights.semantic and
+            weights.lexical. It then replaces both signals.
+    """
+    if not len(results):
+        return results
+    entities = [r.entity for r in results]
+    if fused:
+        scores = (weights.semantic + weights.lexical) * _normalized(
+            np.array([r.score for r in results], dtype=np.float64)
+        )
+    else:
+        scores = weights.semantic * _normalized(
+            np.array([r.similarity for r in results], dtype=np.float64)
+        )
+    if weights.lexical and not fused:
+        scores += weights.lexical * _normalized(
+            np.array([r.lexical_rank or 0 for r in results], dtype=np.float64)
+        )
+    if weights.popularity:
+        scores += weights.popularity * _normalized(popularity_scores(entities))
+    if weights.recency:
+        scores += weights.recency * recency_scores(
+            [e.paper.published for e in entities]
+        )
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    ranked = []
+    for i in order:
+        results[i].score = float(scores[i])
+        ranked.append(results[i])
+    return ranked
+
+
+# Damping constant of reciprocal rank fusion, as in the original RRF paper.
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[str]],
+    k=RRF_K,
+    weights: Optional[Sequence[float]] = None,
+) -> Dict[str, float]:
+    """Merges ranked lists of IDs by summing weight / (k + rank) over the lists each ID
+    appears in. Only ranks are used, so the lists' scores needn't be comparable.
+
+    Returns:
+        Fused score of each ID, best first.
+    """
+    weights = weights or [1] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, id_ in enumerate(ranking):
+            fused[id_] = fused.get(id_, 0) + weight / (k + rank + 1)
+    return dict(sorted(fused.items(), key=lambda item: -item[1]))
+
+
+def weighted_fusion(
+    scored_lists: Sequence[Sequence[Tuple[str, float]]], weights: Sequence[float]
+) -> Dict[str, float]:
+    """Merges lists of (ID, score) pairs by summing each list's scores, normalized by
+    their maximum and multiplied by the list's weight. IDs missing from a list get 0.
+
+    Returns:
+        Fused score of each ID, best first.
+    """
+    fused = {}
+    for scored, weight in zip(scored_lists, weights):
+        if not len(scored):
+            continue
+        scores = _normalized(np.array([score for _, score in scored], dtype=np.float64))
+        for (id_, _), score in zip(scored, scores):
+            fused[id_] = fused.get(id_, 0) + weight * score
+    return dict(sorted(fused.items(), key=lambda item: -item[1]))
@@ -0,0 +1,306 @@
+from lib import cache, database, ranking, vector_index
+import asyncio
+import logging
+import numpy as np
+from typing import List, Optional
+
+# Vector index candidates are over-fetched by this factor to leave room for the
+# filters (e.g. require_social) that are only applied when rows are hydrated.
+CANDIDATE_OVERFETCH = 4
+
+RETRIEVAL_MODES = ("vector", "hybrid")
+FUSION_METHODS = ("rrf", "weighted")
+
+
+async def search_papers(
+    db: database.AsyncDatabase,
+    embeddings=None,
+    index: Optional[vector_index.VectorIndex] = None,
+    exact=False,
+    lexical_query=None,
+    exclude_query=None,
+    top_k=10,
+    start_date=None,
+    end_date=None,
+    require_social=False,
+    weights: Optional[ranking.RankingWeights] = None,
+    lexical_rank_query=None,
+    num_candidates=None,
+    order_by="similarity",
+    retrieval="vector",
+    fusion="rrf",
+    retriever_timeout_ms=None,
+    aggregation="mean",
+    query_weights=None,
+    candidate_cache: Optional[cache.LRUCache] = None,
+    candidate_key=None,
+) -> List[database.SimilarityResult]:
+    """Returns the papers most similar to `embeddings`. Candidates come from `index` when
+    one is available, and Postgres is only used to filter and hydrate them. Otherwise the
+    whole search runs in Postgres. See Database.get_similar_papers for the arguments.
+
+    If `weights` is given, `num_candidates` papers are retrieved and re-ranked with
+    ranking.rank_results, and only the best `top_k` are returned. Hybrid results keep
+    their fused score as the relevance signal, so only popularity and recency are
+    blended on top of it.
+
+    Args:
+        index: Optional in-memory vector index.
+        exact: Whether the index should scan every embedding (for recall checks).
+        weights: Optional ranking weights.
+        lexical_rank_query: Query used for the lexical ranking signal.
+        num_candidates: Number of papers to re-rank. Defaults to `top_k`.
+        retrieval: "vector" to retrieve papers by embedding similarity only, or
+            "hybrid" to also retrieve the best lexical matches of
+            `lexical_rank_query` and fuse both lists (see _hybrid_search).
+        fusion: How hybrid retrieval merges the lists. "rrf" for reciprocal rank
+            fusion, "weighted" for a weighted sum of normalized scores.
+        retriever_timeout_ms: Time budget of each hybrid retriever. A retriever that
+            runs out of time contributes no candidates, and if both do,
+            asyncio.TimeoutError is raised.
+        aggregation: How the similarities to several `embeddings` are combined (see
+            vector_index.AGGREGATIONS).
+        query_weights: Weight of each of `embeddings`, for the "weighted"
+            aggregation.
+        candidate_cache: Optional cache of the `num_candidates` retrieved papers, so
+            that re-ranking them with other weights doesn't retrieve them again.
+        candidate_key: Key identifying every other argument that affects retrieval,
+            for `candidate_cache`.
+    """
+    if retrieval not in RETRIEVAL_MODES:
+        raise ValueError(f"Invalid retrieval '{retrieval}'")
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"Invalid fusion '{fusion}'")
+    num_candidates = max(num_candidates or top_k, top_k)
+    if weights is None:
+        num_candidates = top_k
+    kwargs = dict(
+        lexical_query=lexical_query,
+        exclude_query=exclude_query,
+        top_k=num_candidates,
+        start_date=start_date,
+        end_date=end_date,
+        require_social=require_social,
+        lexical_rank_query=(
+            lexical_rank_query if weights is not None and weights.lexical else None
+        ),
+        order_by=order_by,
+        aggregation=aggregation,
+        query_weights=query_weights,
+    )
+    hybrid = (
+        retrieval == "hybrid"
+        and embeddings is not None
+        and lexical_rank_query
+        and order_by == "similarity"
+    )
+    results = None
+    if candidate_cache is not None and weights is not None:
+        # Which papers are retrieved only depends on the semantic and lexical weights,
+        # so searches that only change the others re-rank the cached candidates.
+        candidate_key = (
+            candidate_key,
+            (weights.semantic, weights.lexical) if hybrid else bool(weights.lexical),
+        )
+        results = candidate_cache.get(candidate_key)
+    if results is None:
+        results = await _retrieve(
+            db,
+            embeddings,
+            index,
+            exact,
+            hybrid,
+            lexical_rank_query,
+            fusion,
+            weights,
+            retriever_timeout_ms,
+            **kwargs,
+        )
+        if candidate_cache is not None and weights is not None:
+            candidate_cache.put(candidate_key, results)
+    if weights is not None:
+        # rank_results sets `score`, so leave the cached results untouched.
+        results = ranking.rank_results(
+            [r.copy() for r in results], weights, top_k=top_k, fused=hybrid
+        )
+    return results
+
+
+async def _retrieve(
+    db,
+    embeddings,
+    index,
+    exact,
+    hybrid,
+    lexical_rank_query,
+    fusion,
+    weights,
+    retriever_timeout_ms,
+    **kwargs,
+):
+    if hybrid:
+        return await _hybrid_search(
+            db,
+            embeddings,
+            index,
+            exact,
+            lexical_rank_query,
+            fusion,
+            weights,
+            retriever_timeout_ms,
+            **kwargs,
+        )
+    # Lexical filters can be arbitrarily selective, so let Postgres use its GIN index.
+    if (
+        index is None
+        or embeddings is None
+        or kwargs["lexical_query"]
+        or kwargs["order_by"] != "similarity"
+    ):
+        return await db.get_similar_papers(embeddings=embeddings, **kwargs)
+    return await _search_with_index(db, embeddings, index, exact, **kwargs)
+
+
+async def _search_with_index(db, embeddings, index, exact, **kwargs):
+    queries = np.asarray(embeddings, dtype=np.float32)
+    top_k = kwargs["top_k"]
+    k = top_k * CANDIDATE_OVERFETCH
+    # A quantized index only approximates similarities. Take more candidates from it
+    # and let Postgres rescore them with the full-precision embeddings.
+    rescore = index.quantization is not None
+    if rescore:
+        k = max(k, index.rescore_candidates)
+    while True:
+        # Scanning the index is CPU-bound, so keep it off the event loop.
+        arxiv_ids, similarities = await asyncio.to_thread(
+            index.search,
+            queries,
+            k,
+            start_date=kwargs["start_date"],
+            end_date=kwargs["end_date"],
+            exact=exact,
+            aggregation=kwargs["aggregation"],
+            weights=kwargs["query_weights"],
+        )
+        results = await db.get_similar_papers(
+            embeddings=embeddings,
+            candidates=dict(zip(arxiv_ids, similarities.tolist())),
+            rescore=rescore,
+            **kwargs,
+        )
+        if len(results) >= top_k or len(arxiv_ids) < k:
+            return results
+        k *= CANDIDATE_OVERFETCH
+
+
+async def _with_timeout(name, coroutine, timeout_ms):
+    try:
+        return await asyncio.wait_for(
+            coroutine, timeout_ms / 1000 if timeout_ms is not None else None
+        )
+    except asyncio.TimeoutError:
+        logging.warning(f"{name} retrieval timed out after {timeout_ms}ms.")
+        return None
+
+
+async def _vector_candidates(db, embeddings, index, exact, **kwargs):
+    """Returns (arxiv_id, similarity) pairs of the most similar papers."""
+    if index is None:
+        results = await db.get_similar_papers(embeddings=embeddings, **kwargs)
+        return [(r.entity.paper.arxiv_id, r.similarity) for r in results]
+    k = kwargs["top_k"] * CANDIDATE_OVERFETCH
+    if index.quantization is not None:
+        k = max(k, index.rescore_candidates)
+    arxiv_ids, similarities = await asyncio.to_thread(
+        index.search,
+        np.asarray(embeddings, dtype=np.float32),
+        k,
+        start_date=kwargs["start_date"],
+        end_date=kwargs["end_date"],
+        exact=exact,
+        aggregation=kwargs["aggregation"],
+        weights=kwargs["query_weights"],
+    )
+    return list(zip(arxiv_ids, similarities.tolist()))
+
+
+async def _hybrid_search(
+    db,
+    embeddings,
+    index,
+    exact,
+    lexical_text,
+    fusion,
+    weights,
+    timeout_ms,
+    **kwargs,
+):
+    """Retrieves the papers most similar to `embeddings` and the best lexical matches
+    of `lexical_text` concurrently, fuses the two rankings, and hydrates the fused
+    candidates. Returns the best `top_k` candidates by fused score, which is also set
+    as their `score`. Raises asyncio.TimeoutError if both retrievers timed out."""
+    top_k = kwargs["top_k"]
+    retriever_kwargs = dict(
+        start_date=kwargs["start_date"],
+        end_date=kwargs["end_date"],
+        require_social=kwargs["require_social"],
+        exclude_query=kwargs["exclude_query"],
+        aggregation=kwargs["aggregation"],
+        query_weights=kwargs["query_weights"],
+    )
+    vector, lexical = await asyncio.gather(
+        _with_timeout(
+            "Vector",
+            _vector_candidates(
+                db,
+                embeddings,
+                index,
+                exact,
+                top_k=top_k,
+                lexical_query=kwargs["lexical_query"],
+                **retriever_kwargs,
+            ),
+            timeout_ms,
+        ),
+        _with_timeout(
+            "Lexical",
+            db.get_lexical_candidates(
+                lexical_text,
+                embeddings=embeddings,
+                top_k=top_k,
+                timeout_ms=timeout_ms,
+                **retriever_kwargs,
+            ),
+            timeout_ms,
+        ),
+    )
+    if vector is None and lexical is None:
+        raise asyncio.TimeoutError("Vector and lexical retrieval both timed out.")
+    vector, lexical = vector or [], lexical or []
+    fusion_weights = [weights.semantic, weights.lexical] if weights else [1, 1]
+    if fusion == "rrf":
+        fused = ranking.reciprocal_rank_fusion(
+            [[arxiv_id for arxiv_id, _ in vector], [row[0] for row in lexical]],
+            weights=fusion_weights,
+        )
+    else:
+        fused = ranking.weighted_fusion(
+            [vector, [(arxiv_id, rank) for arxiv_id, rank, _ in lexical]],
+            fusion_weights,
+        )
+    similarities = dict(vector)
+    similarities.update({arxiv_id: sim for arxiv_id, _, sim in lexical})
+
+    # Filters not applied by the retrievers (e.g. require_social for the vector
+    # index) are applied here, so hydrate every candidate and cut afterwards.
+    results = await db.get_similar_papers(
+        embeddings=embeddings,
+        candidates={arxiv_id: similarities[arxiv_id] for arxiv_id in fused},
+        # Similarities from a quantized index are approximate.
+        rescore=index is not None and index.quantization is not None,
+        **{**kwargs, "top_k": len(fused)},
+    )
+    for r in results:
+        r.score = fused[r.entity.paper.arxiv_id]
+    results.sort(key=lambda r: -r.score)
+    return results[:top_k]
@@ -0,0 +1,59 @@
+"""Fast encoding of search responses. Results are turned into plain dicts with the same
+shape as FastAPI's jsonable_encoder output and encoded with orjson (or msgpack), which
+skips pydantic's per-field validation and encoding."""
+from lib import arxiv, database
+from typing import List
+import msgpack
+import orjson
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+_PAPER_FIELDS = list(arxiv.ArxivPaper.__fields__)
+# "paper" comes first, as in ArxivEntity.
+_ENTITY_FIELDS = [f for f in database.ArxivEntity.__fields__ if f != "paper"]
+
+
+def _result_to_dict(result: database.SimilarityResult):
+    entity = result.entity
+    paper = entity.paper
+    entity_dict = {"paper": {f: getattr(paper, f) for f in _PAPER_FIELDS}}
+    for f in _ENTITY_FIELDS:
+        entity_dict[f] = getattr(entity, f)
+    return {
+        "entity": entity_dict,
+        "similarity": result.similarity,
+        "lexical_rank": result.lexical_rank,
+        "score": result.score,
+    }
+
+
+def search_response(results: List[database.SimilarityResult]):
+    """Returns the /search response body for `results` as plain Python objects."""
+    return {"data": [_result_to_dict(r) for r in results]}
+
+
+def _msgpack_default(obj):
+    # Same representations as in the JSON response.
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Cannot serialize {type(obj)}")
+
+
+def negotiate_media_type(accept_header):
+    """Returns the msgpack media type if the Accept header asks for it, and JSON
+    otherwise."""
+    for media_type in (accept_header or "").split(","):
+        media_type = media_type.split(";")[0].strip()
+        if media_type in MSGPACK_MEDIA_TYPES:
+            return media_type
+    return JSON_MEDIA_TYPE
+
+
+def encode(content, media_type=JSON_MEDIA_TYPE) -> bytes:
+    """Encodes `content` (e.g. from search_response) as JSON or msgpack."""
+    if media_type in MSGPACK_MEDIA_TYPES:
+        return msgpack.packb(content, default=_msgpack_default)
+    return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
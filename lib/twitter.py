@@ -2,8 +2,10 @@ import requests
 from requests.adapters import HTTPAdapter, Retry
 import pydantic
 from datetime import datetime
-from typing import List, Optional
-import bs4
+from typing import Dict, List, Optional
+import asyncio
+import httpx
+import logging
 
 from lib import arxiv
 from lib import util
@@ -215,22 +217,96 @@ class TwitterAPI:
         return response.json()
 
 
+OEMBED_URL = "https://publish.twitter.com/oembed"
+OEMBED_RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def _open_links_in_new_tab(html):
+    # Imported on first use, to keep web startup fast.
+    import bs4
+
+    # features=lxml so it uses the right parser
+    soup = bs4.BeautifulSoup(html, features="lxml")
+    for link in soup.find_all("a"):
+        link["target"] = "_blank"
+    return str(soup)
+
+
 def getEmbeddedTweetHtml(tweet_id):
     with requests.Session() as s:
         retries = Retry(
-            total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504]
+            total=3, backoff_factor=0.1, status_forcelist=list(OEMBED_RETRY_STATUSES)
         )
         s.mount("https://", HTTPAdapter(max_retries=retries))
         try:
             response = s.get(
-                "https://publish.twitter.com/oembed",
+                OEMBED_URL,
                 params={"url": f"https://twitter.com/x/status/{tweet_id}"},
             )
             response.raise_for_status()
         except requests.exceptions.HTTPError as err:
             raise err
-    # features=lxml so it uses the right parser
-    soup = bs4.BeautifulSoup(response.json()["html"], features="lxml")
-    for link in soup.find_all("a"):
-        link["target"] = "_blank"
-    return str(soup)
+    return _open_links_in_new_tab(response.json()["html"])
+
+
+class AsyncOEmbedClient:
+    """Fetches embedded tweet HTML from Twitter's oEmbed API without blocking the event
+    loop. Requests share one connection pool and at most `max_concurrency` are in
+    flight at once."""
+
+    def __init__(self, max_concurrency=8, timeout=10, retries=3, backoff_factor=0.1):
+        """
+        Args:
+            max_concurrency: Maximum number of concurrent requests.
+            timeout: Request timeout in seconds.
+            retries: Number of retries on connection errors and 5xx responses.
+            backoff_factor: Retry i waits backoff_factor * 2**i seconds.
+        """
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+    async def _get(self, tweet_id):
+        params = {"url": f"https://twitter.com/x/status/{tweet_id}"}
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = await self._client.get(OEMBED_URL, params=params)
+                if response.status_code not in OEMBED_RETRY_STATUSES or last_attempt:
+                    response.raise_for_status()
+                    return response.json()["html"]
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            await asyncio.sleep(self.backoff_factor * 2**attempt)
+
+    async def get_html(self, tweet_id) -> str:
+        """Returns the embedded HTML of a tweet, with links opening in a new tab."""
+        async with self._semaphore:
+            html = await self._get(tweet_id)
+        return _open_links_in_new_tab(html)
+
+    async def get_many(self, tweet_ids) -> Dict[str, str]:
+        """Returns the embedded HTML of each tweet keyed by tweet ID. Tweets that
+        couldn't be fetched (e.g. deleted ones) are left out."""
+        tweet_ids = list(tweet_ids)
+        results = await asyncio.gather(
+            *[self.get_html(t) for t in tweet_ids], return_exceptions=True
+        )
+        htmls = {}
+        for tweet_id, result in zip(tweet_ids, results):
+            if isinstance(result, Exception):
+                logging.warning(f"Failed to embed tweet {tweet_id}: {result}")
+            else:
+                htmls[tweet_id] = result
+        return htmls
+
+    async def aclose(self):
+        await self._client.aclose()
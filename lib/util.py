@@ -1,6 +1,7 @@
 from datetime import datetime
 import os
 from dotenv import load_dotenv
+import itertools
 import math
 
 ISO_FMT = "%Y-%m-%dT%H:%M:%S.%fZ"
@@ -72,3 +73,10 @@ def create_intervals(start, end, num_blocks):
     if len(res) == num_blocks:
         res[-1][1] = end
     return res
+
+
+def batched(iterable, n):
+    """Yields successive lists of up to `n` items from `iterable`."""
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
@@ -0,0 +1,406 @@
+from lib import util
+import numpy as np
+import contextlib
+import fcntl
+import json
+import logging
+import math
+import os
+import shutil
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+# Compact in-memory representations of the embeddings (see VectorIndex).
+QUANTIZATIONS = (None, "int8", "binary")
+
+# Number of set bits in each byte value.
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+# File in a snapshot directory naming the latest snapshot (see save_snapshot).
+SNAPSHOT_POINTER = "CURRENT"
+# Lock file under the snapshot directory (see snapshot_lock).
+SNAPSHOT_LOCK = ".lock"
+
+# Ways of combining the similarities of a paper to each vector of a multi-vector query.
+AGGREGATIONS = ("mean", "max", "min", "weighted")
+
+
+def linear_query_weights(
+    num_queries, aggregation="mean", weights: Optional[Sequence[float]] = None
+) -> Optional[np.ndarray]:
+    """Returns the weight of each query vector (summing to 1) for the linear
+    aggregations, mean and weighted, and None for max and min.
+
+    A linear aggregation of dot products equals the dot product with the same
+    combination of the query vectors, so such queries can be scored as a single vector.
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Invalid aggregation '{aggregation}'")
+    if aggregation in ("max", "min"):
+        return None
+    if aggregation == "mean" or weights is None:
+        return np.full(num_queries, 1 / num_queries, dtype=np.float32)
+    weights = np.asarray(weights, dtype=np.float32)
+    if weights.shape != (num_queries,) or (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError("Need one non-negative weight per query vector")
+    return weights / weights.sum()
+
+
+def aggregate_scores(
+    scores: np.ndarray, aggregation="mean", weights=None
+) -> np.ndarray:
+    """Combines a (candidates, num_queries) matrix of similarities into one score per
+    candidate."""
+    linear_weights = linear_query_weights(scores.shape[1], aggregation, weights)
+    if linear_weights is not None:
+        return scores @ linear_weights
+    return scores.max(axis=1) if aggregation == "max" else scores.min(axis=1)
+
+
+class VectorIndex:
+    """In-memory approximate nearest neighbour index over normalized paper embeddings.
+
+    Embeddings are clustered with spherical k-means into an inverted file (IVF): each
+    cluster's rows are stored contiguously, and a query only scans the `nprobe` clusters
+    whose centroids score highest against it. Small corpora are scanned exhaustively.
+
+    Embeddings can also be stored quantized, as int8 (4x smaller) or as 1-bit sign
+    sketches (32x smaller). Scores are then approximate, so callers should retrieve
+    `rescore_candidates` rows and rescore them against the full-precision vectors (e.g.
+    in Postgres, see search.search_papers).
+    """
+
+    def __init__(
+        self,
+        arxiv_ids: List[str],
+        embeddings: np.ndarray,
+        published_ts: List,
+        nlist=None,
+        nprobe=16,
+        exact_threshold=5000,
+        kmeans_iters=10,
+        seed=0,
+        quantization=None,
+        rescore_candidates=200,
+    ):
+        """
+        Args:
+            arxiv_ids: Arxiv ID of each row of `embeddings`.
+            embeddings: (N, dim) matrix of L2-normalized embeddings.
+            published_ts: Publication datetime of each row (may contain None).
+            nlist: Number of IVF clusters. Defaults to sqrt(N).
+            nprobe: Number of clusters scanned per query.
+            exact_threshold: Corpora smaller than this are always scanned exhaustively.
+            kmeans_iters: Number of k-means iterations used to train the clusters.
+            seed: Random seed for k-means initialization.
+            quantization: None to store float32 embeddings, or one of QUANTIZATIONS.
+            rescore_candidates: Number of candidates that should be rescored with
+                full-precision vectors, when quantized.
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Invalid quantization '{quantization}'")
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(arxiv_ids):
+            raise ValueError("embeddings must be a (len(arxiv_ids), dim) matrix")
+        published = np.array(
+            [np.datetime64(p if p is not None else "NaT", "s") for p in published_ts],
+            dtype="datetime64[s]",
+        )
+        n = embeddings.shape[0]
+        self.nprobe = nprobe
+        self._centroids = None
+        self._offsets = None
+        order = np.arange(n)
+        if n >= exact_threshold:
+            nlist = nlist or int(math.sqrt(n))
+            self._centroids, assignments = self._train_ivf(
+                embeddings, nlist, kmeans_iters, seed
+            )
+            # Store rows grouped by cluster so each probe is a contiguous slice.
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=len(self._centroids))
+            self._offsets = np.concatenate([[0], np.cumsum(counts)])
+        # Fixed-width strings rather than objects, so snapshots can be memory-mapped.
+        self._ids = np.asarray(arxiv_ids, dtype=str)[order]
+        self._published = published[order]
+        self._dim = embeddings.shape[1]
+        self.quantization = quantization
+        self.rescore_candidates = rescore_candidates
+        self._embeddings = None
+        self._codes = None
+        self._scale = None
+        if quantization is None:
+            self._embeddings = embeddings[order]
+        elif quantization == "int8":
+            # Symmetric per-dimension scale, so each dimension uses the whole range.
+            self._scale = np.maximum(np.abs(embeddings).max(axis=0), 1e-12) / 127
+            self._codes = np.round(embeddings[order] / self._scale).astype(np.int8)
+        else:
+            self._codes = np.packbits(embeddings[order] > 0, axis=1)
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def dim(self):
+        return self._dim
+
+    @property
+    def nbytes(self):
+        """Memory used by the stored embeddings (or their codes)."""
+        vectors = self._embeddings if self._codes is None else self._codes
+        return vectors.nbytes + (self._scale.nbytes if self._scale is not None else 0)
+
+    def _scores(self, rows, queries, chunk_size=65536):
+        """Returns the (len(rows), len(queries)) matrix of dot products, approximated
+        from the codes if the embeddings are quantized."""
+        if self._codes is None:
+            return self._embeddings[rows] @ queries.T
+        scores = np.empty((len(rows), len(queries)), dtype=np.float32)
+        if self.quantization == "int8":
+            scaled_queries = (queries * self._scale).T
+        else:
+            query_bits = np.packbits(queries > 0, axis=1)
+        # Chunked, so decoding never materializes a full-precision copy.
+        for i in range(0, len(rows), chunk_size):
+            codes = self._codes[rows[i : i + chunk_size]]
+            if self.quantization == "int8":
+                scores[i : i + chunk_size] = codes.astype(np.float32) @ scaled_queries
+            else:
+                for j, bits in enumerate(query_bits):
+                    hamming = _POPCOUNT[codes ^ bits].sum(axis=1)
+                    # Matching signs estimate the angle between the vectors.
+                    scores[i : i + chunk_size, j] = np.cos(np.pi * hamming / self._dim)
+        return scores
+
+    @staticmethod
+    def _train_ivf(embeddings, nlist, iters, seed, chunk_size=8192):
+        rng = np.random.default_rng(seed)
+        n = embeddings.shape[0]
+        centroids = embeddings[rng.choice(n, size=nlist, replace=False)].copy()
+        assignments = np.zeros(n, dtype=np.int64)
+        for _ in range(iters):
+            for i in range(0, n, chunk_size):
+                scores = embeddings[i : i + chunk_size] @ centroids.T
+                assignments[i : i + chunk_size] = np.argmax(scores, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, embeddings)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            # Re-seed empty clusters with random rows.
+            if empty.any():
+                sums[empty] = embeddings[rng.choice(n, size=int(empty.sum()))]
+                norms[empty] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+        return centroids, assignments
+
+    def _date_mask(self, rows, start_date, end_date):
+        published = self._published if rows is None else self._published[rows]
+        mask = np.ones(len(published), dtype=bool)
+        if start_date:
+            mask &= published >= np.datetime64(start_date.date(), "s")
+        if end_date:
+            mask &= published < np.datetime64(end_date.date() + timedelta(days=1), "s")
+        return mask
+
+    @staticmethod
+    def _top_k(scores, k):
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def _probe_rows(self, queries):
+        # Union of the clusters probed for each query vector.
+        nprobe = min(self.nprobe, len(self._centroids))
+        lists = np.argpartition(-(queries @ self._centroids.T), nprobe - 1, axis=1)
+        lists = np.unique(lists[:, :nprobe])
+        return np.concatenate(
+            [np.arange(self._offsets[c], self._offsets[c + 1]) for c in lists]
+        )
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        start_date=None,
+        end_date=None,
+        exact=False,
+        aggregation="mean",
+        weights: Optional[Sequence[float]] = None,
+    ) -> Tuple[List[str], np.ndarray]:
+        """Returns the `k` rows with the highest dot product against `query`.
+
+        Args:
+            query: Query vector of size `dim`, or a (num_queries, dim) matrix for
+                multi-vector queries.
+            k: Number of results.
+            start_date: Earliest publication date.
+            end_date: Latest publication date.
+            exact: Whether to scan every row instead of only the probed clusters.
+            aggregation: How the dot products against each query vector are combined
+                (see AGGREGATIONS).
+            weights: Weight of each query vector, for the "weighted" aggregation.
+
+        Returns:
+            (arxiv_ids, similarities), sorted by decreasing similarity. Similarities
+            are approximate if the index is quantized.
+        """
+        queries = np.atleast_2d(np.asarray(query, dtype=np.float32))
+        linear_weights = linear_query_weights(len(queries), aggregation, weights)
+        if linear_weights is not None:
+            # Scores as a single vector, at the cost of a one-vector query.
+            queries = (linear_weights @ queries)[None, :]
+        rows = None
+        if not exact and self._centroids is not None:
+            rows = self._probe_rows(queries)
+            mask = self._date_mask(rows, start_date, end_date)
+            # Restrictive date ranges can leave too few rows in the probed clusters.
+            if mask.sum() < k:
+                rows = None
+            else:
+                rows = rows[mask]
+        if rows is None:
+            rows = np.flatnonzero(self._date_mask(None, start_date, end_date))
+        scores = self._scores(rows, queries)
+        if linear_weights is not None:
+            scores = scores[:, 0]
+        else:
+            scores = aggregate_scores(scores, aggregation)
+        top = self._top_k(scores, k)
+        return self._ids[rows[top]].tolist(), scores[top]
+
+    def save(self, path):
+        """Writes the index to the directory `path` as uncompressed .npy files, which
+        `load` can memory-map."""
+        os.makedirs(path, exist_ok=True)
+        vectors = self._embeddings if self._codes is None else self._codes
+        arrays = {
+            "ids": self._ids,
+            "published": self._published,
+            "vectors": vectors,
+            "centroids": self._centroids,
+            "offsets": self._offsets,
+            "scale": self._scale,
+        }
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+        meta = {
+            "dim": self._dim,
+            "nprobe": self.nprobe,
+            "quantization": self.quantization,
+            "rescore_candidates": self.rescore_candidates,
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap=True) -> "VectorIndex":
+        """Loads an index written by `save`. With `mmap`, the arrays are mapped
+        read-only rather than read, so processes loading the same files share their
+        pages in the OS page cache."""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        def load_array(name):
+            filename = os.path.join(path, f"{name}.npy")
+            if not os.path.exists(filename):
+                return None
+            return np.load(filename, mmap_mode="r" if mmap else None)
+
+        index = cls.__new__(cls)
+        index.nprobe = meta["nprobe"]
+        index.quantization = meta["quantization"]
+        index.rescore_candidates = meta["rescore_candidates"]
+        index._dim = meta["dim"]
+        index._ids = load_array("ids")
+        index._published = load_array("published")
+        index._centroids = load_array("centroids")
+        index._offsets = load_array("offsets")
+        index._scale = load_array("scale")
+        vectors = load_array("vectors")
+        index._embeddings = vectors if index.quantization is None else None
+        index._codes = vectors if index.quantization is not None else None
+        return index
+
+
+def config_from_env():
+    """VectorIndex arguments set through environment variables."""
+    return dict(
+        # "int8" or "binary" to keep compact codes in memory (see VectorIndex).
+        quantization=util.get_env_var("VECTOR_INDEX_QUANTIZATION") or None,
+        rescore_candidates=int(util.get_env_var("VECTOR_INDEX_RESCORE", 200)),
+    )
+
+
+def build_from_database(db, **kwargs) -> Optional[VectorIndex]:
+    """Loads every stored embedding from `db` into a new VectorIndex. Returns None if
+    there are no embeddings yet."""
+    arxiv_ids, published_ts, embeddings = db.get_embedding_matrix()
+    if not len(arxiv_ids):
+        return None
+    index = VectorIndex(arxiv_ids, embeddings, published_ts, **kwargs)
+    logging.info(f"Built vector index over {len(index)} embeddings.")
+    return index
+
+
+def current_snapshot(root) -> Optional[str]:
+    """Returns the path of the latest snapshot under `root`, or None if there is
+    none."""
+    try:
+        with open(os.path.join(root, SNAPSHOT_POINTER)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(root, name) if name else None
+
+
+@contextlib.contextmanager
+def snapshot_lock(root):
+    """Holds an exclusive lock on the snapshots under `root`, shared by every process
+    using it (an fcntl.flock of SNAPSHOT_LOCK). Blocks until the lock is free."""
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, SNAPSHOT_LOCK), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_snapshot(index: VectorIndex, root, keep=2) -> str:
+    """Saves `index` to a new snapshot directory under `root` and points
+    SNAPSHOT_POINTER to it. The directory and the pointer are both swapped in
+    atomically, so readers never see a partial snapshot.
+
+    Args:
+        index: Index to save.
+        root: Directory holding the snapshots.
+        keep: Number of snapshots kept. Older ones are deleted; processes that mapped
+            them keep their pages until they reload.
+
+    Returns:
+        Path of the new snapshot.
+    """
+    os.makedirs(root, exist_ok=True)
+    name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{os.getpid()}"
+    tmp_path = os.path.join(root, f".{name}.tmp")
+    index.save(tmp_path)
+    os.replace(tmp_path, os.path.join(root, name))
+    tmp_pointer = os.path.join(root, f".{SNAPSHOT_POINTER}.{os.getpid()}.tmp")
+    with open(tmp_pointer, "w") as f:
+        f.write(name)
+    os.replace(tmp_pointer, os.path.join(root, SNAPSHOT_POINTER))
+    # Snapshot names sort chronologically.
+    snapshots = sorted(
+        d
+        for d in os.listdir(root)
+        if not d.startswith(".") and os.path.isdir(os.path.join(root, d))
+    )
+    for old in snapshots[:-keep]:
+        if old != name:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    logging.info(f"Saved vector index snapshot {name} ({len(index)} embeddings).")
+    return os.path.join(root, name)
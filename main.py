@@ -1,19 +1,29 @@
 from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
-from lib import database, embedding, util, twitter
-from pipeline import run_pipeline
+
+# lib.embedding (torch, transformers) and the pipeline are imported where they are
+# used, so they don't delay serving requests on a cold start.
+from lib import cache, database, inference, util, twitter, ranking
+from lib import serialization
+from lib import vector_index
+from lib import search as search_lib
 import logging
 import asyncio
 import threading
+from concurrent import futures
 from typing import List, Annotated
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timedelta
 import hashlib
 import hmac
+import json
 import random
 import time
 import os
 import requests
+import numpy as np
+import pydantic
 
 # from fastapi.utils import tasks
 
@@ -38,6 +48,24 @@ fastapi_app.add_middleware(
 )
 
 db = database.Database()
+# Request handlers query through this pool so they don't block the event loop.
+async_db = database.AsyncDatabase(
+    db,
+    min_size=int(util.get_env_var("DB_POOL_MIN_SIZE", 1)),
+    max_size=int(util.get_env_var("DB_POOL_MAX_SIZE", 10)),
+)
+
+
+@fastapi_app.on_event("startup")
+async def open_async_db():
+    await async_db.open()
+
+
+@fastapi_app.on_event("shutdown")
+async def close_async_db():
+    await async_db.close()
+    await _oembed_client.aclose()
+
 
 # Event loop
 # try:
@@ -72,33 +100,251 @@ _MODEL = None
 
 
 class ModelHandlerV2:
-    def __init__(self):
-        logging.info("Starting model loading")
-        model = embedding.SentenceTransformer()
+    def __init__(self, model=None):
+        """
+        Args:
+            model: Already loaded embedding.SentenceTransformer. Loaded here if None.
+        """
+        if model is None:
+            from lib import embedding
+
+            logging.info("Starting model loading")
+            model = embedding.SentenceTransformer()
         model.embed(["t"])
         logging.info("Model loading complete.")
         self._model = model
+        # Query embeddings keyed by normalized query text, bounded by total bytes.
+        ttl = util.get_env_var("QUERY_CACHE_TTL")
+        self.cache = cache.LRUCache(
+            max_size=int(util.get_env_var("QUERY_CACHE_BYTES", 64 * 2**20)),
+            ttl=float(ttl) if ttl else None,
+            sizeof=lambda e: e.nbytes,
+        )
+        # Batches forward passes of concurrent searches together.
+        self.embedder = inference.BatchingEmbedder(
+            model,
+            max_wait_ms=float(util.get_env_var("INFERENCE_MAX_WAIT_MS", 5)),
+            max_batch_size=int(util.get_env_var("INFERENCE_MAX_BATCH_SIZE", 64)),
+        )
 
     def get_embedding_model(self):
         return self._model
 
+    @staticmethod
+    def _normalize_query(query):
+        # The model is uncased, so case and whitespace don't change the embedding.
+        return " ".join(query.lower().split())
+
+    def _lookup(self, queries):
+        keys = [self._normalize_query(q) for q in queries]
+        embeddings = {k: self.cache.get(k) for k in set(keys)}
+        missing = [k for k, e in embeddings.items() if e is None]
+        return keys, embeddings, missing
+
+    def _store(self, embeddings, missing, missing_embeddings):
+        for k, e in zip(missing, missing_embeddings):
+            # Copy so the cache doesn't keep the whole batch's array alive.
+            e = np.array(e, dtype=np.float32)
+            self.cache.put(k, e)
+            embeddings[k] = e
+
+    def embed(self, queries):
+        """Embeds `queries`, only running the model on those not already cached.
+        Returns a list of float32 arrays."""
+        keys, embeddings, missing = self._lookup(queries)
+        if missing:
+            self._store(embeddings, missing, self.embedder.submit(missing).result())
+        return [embeddings[k] for k in keys]
+
+    async def embed_async(self, queries):
+        """Same as embed, but awaits the batching embedder instead of blocking."""
+        keys, embeddings, missing = self._lookup(queries)
+        if missing:
+            future = self.embedder.submit(missing)
+            self._store(embeddings, missing, await asyncio.wrap_future(future))
+        return [embeddings[k] for k in keys]
+
 
 _model_handler = None
+_vector_index = None
+
+
+def _make_result_cache():
+    """Cache of encoded /search responses. Shared between worker processes through a
+    SQLite file if SEARCH_CACHE_PATH is set, and kept in memory otherwise."""
+    path = util.get_env_var("SEARCH_CACHE_PATH")
+    if path:
+        return cache.SqliteCache(
+            path, max_entries=int(util.get_env_var("SEARCH_CACHE_ENTRIES", 10000))
+        )
+    return cache.LRUCache(
+        max_size=int(util.get_env_var("SEARCH_CACHE_BYTES", 128 * 2**20)), sizeof=len
+    )
+
+
+_result_cache = _make_result_cache()
+# Social data per arxiv ID, keyed by (data version, arxiv ID).
+_social_cache = cache.LRUCache(
+    max_size=int(util.get_env_var("SOCIAL_CACHE_ENTRIES", 10000))
+)
+# Retrieved candidates of ranked searches (see search_lib.search_papers), so that
+# moving a ranking slider only re-ranks them.
+_candidate_cache = cache.LRUCache(
+    max_size=int(util.get_env_var("CANDIDATE_CACHE_ENTRIES", 32))
+)
+_data_version = cache.DataVersion()
+
+
+# With PRELOAD_MODEL=1 and gunicorn's preload_app (see gunicorn.conf.py), the model is
+# loaded once in the gunicorn master, before it forks the workers. The workers share
+# its weights copy-on-write, since inference never writes them; this holds for the
+# packed weights of the torch_int8 backend too. The workers only start serving once it
+# has loaded, so this trades the fast first /ping for memory. ONNX Runtime sessions
+# don't survive a fork, so the onnx backend is always loaded by each worker.
+_preloaded_model = None
+if (
+    util.get_env_var("PRELOAD_MODEL", "0") == "1"
+    and util.get_env_var("EMBEDDING_BACKEND", "torch") != "onnx"
+):
+    from lib import embedding
+
+    logging.info("Preloading model")
+    _preloaded_model = embedding.SentenceTransformer()
 
 
 def load_model_handler():
     global _model_handler
-    _model_handler = ModelHandlerV2()
+    _model_handler = ModelHandlerV2(model=_preloaded_model)
+    return _model_handler
+
 
+# Directory of memory-mapped index snapshots shared by the worker processes (see
+# vector_index.save_snapshot). If unset, each worker builds its own index.
+VECTOR_INDEX_SNAPSHOT_DIR = util.get_env_var("VECTOR_INDEX_SNAPSHOT_DIR")
+# Seconds to wait before retrying a failed index load.
+VECTOR_INDEX_RETRY_SECONDS = 60
+# Data version and snapshot path the current index was loaded at.
+_vector_index_version = None
+_vector_index_snapshot = None
+# time.monotonic() of the last failed load, if the last load failed.
+_vector_index_failed_at = None
+_vector_index_lock = threading.Lock()
+
+
+def _load_vector_index():
+    """Returns the latest index snapshot and its path if VECTOR_INDEX_SNAPSHOT_DIR is
+    set. If there is no snapshot yet (e.g. the directory is on the machine's ephemeral
+    disk), the first worker to take the snapshot lock builds and saves one, and the
+    others wait for it and load it. Without VECTOR_INDEX_SNAPSHOT_DIR, the index is
+    built from the embeddings currently in the DB."""
+    config = vector_index.config_from_env()
+    if not VECTOR_INDEX_SNAPSHOT_DIR:
+        return vector_index.build_from_database(db, **config), None
+    snapshot = vector_index.current_snapshot(VECTOR_INDEX_SNAPSHOT_DIR)
+    if snapshot is None:
+        with vector_index.snapshot_lock(VECTOR_INDEX_SNAPSHOT_DIR):
+            snapshot = vector_index.current_snapshot(VECTOR_INDEX_SNAPSHOT_DIR)
+            if snapshot is None:
+                index = vector_index.build_from_database(db, **config)
+                if index is None:
+                    return None, None
+                snapshot = vector_index.save_snapshot(index, VECTOR_INDEX_SNAPSHOT_DIR)
+    if snapshot == _vector_index_snapshot:
+        return _vector_index, snapshot
+    # Loaded even by the worker that built it, so that every worker maps the same
+    # pages.
+    index = vector_index.VectorIndex.load(snapshot)
+    logging.info(f"Loaded vector index snapshot {snapshot}.")
+    return index, snapshot
+
+
+def refresh_vector_index():
+    """Loads the latest vector index (see _load_vector_index). The data version it was
+    loaded at is only recorded if loading succeeds, so failed loads are retried."""
+    global _vector_index, _vector_index_version, _vector_index_snapshot
+    global _vector_index_failed_at
+    with _vector_index_lock:
+        version = _data_version.get()
+        try:
+            index, snapshot = _load_vector_index()
+        except Exception as ex:
+            # Searches fall back to scanning in Postgres without an index.
+            logging.error(f"Failed to load vector index: {ex}")
+            _vector_index_failed_at = time.monotonic()
+            return
+        # Set in this order so that searches never see the new version with the old
+        # index (see search).
+        _vector_index = index
+        _vector_index_snapshot = snapshot
+        _vector_index_version = version
+        _vector_index_failed_at = None
+
+
+def maybe_refresh_vector_index():
+    """Reloads the index in the background if the pipeline has written new data since
+    it was loaded, e.g. from another worker process, or if the last load failed more
+    than VECTOR_INDEX_RETRY_SECONDS ago. The current index keeps serving searches
+    meanwhile."""
+    if _vector_index_lock.locked():
+        return
+    if _vector_index_failed_at is not None:
+        elapsed = time.monotonic() - _vector_index_failed_at
+        refresh = elapsed >= VECTOR_INDEX_RETRY_SECONDS
+    else:
+        refresh = (
+            _vector_index_version is not None
+            and _vector_index_version != _data_version.get()
+        )
+    if refresh:
+        threading.Thread(target=refresh_vector_index).start()
 
-load_thread = threading.Thread(target=load_model_handler)
-load_thread.start()
+
+_inference_executor = None
+_model_future = None
+
+
+@fastapi_app.on_event("startup")
+def start_loading():
+    """Starts loading the model and the vector index in the background. Runs in each
+    worker process, because threads started before gunicorn forks don't exist in the
+    workers."""
+    global _inference_executor, _model_future
+    # Loads the model off the event loop. Forward passes run on the handler's
+    # BatchingEmbedder thread.
+    _inference_executor = futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="inference"
+    )
+    _model_future = _inference_executor.submit(load_model_handler)
+    threading.Thread(target=refresh_vector_index).start()
+
+
+# Seconds clients are told to wait before retrying while the model loads.
+MODEL_LOADING_RETRY_AFTER = 5
 
 
 def model_handler() -> ModelHandlerV2:
-    while _model_handler is None:
-        continue
-    return _model_handler
+    """Blocks until the model is loaded. Only call this outside the event loop."""
+    return _model_future.result()
+
+
+def ready_model_handler() -> ModelHandlerV2:
+    """Returns the model handler, or responds with a 503 if it is still loading."""
+    if not _model_future.done():
+        raise HTTPException(
+            status_code=503,
+            detail="Model is loading.",
+            headers={"Retry-After": str(MODEL_LOADING_RETRY_AFTER)},
+        )
+    return _model_future.result()
+
+
+async def wait_for_model_handler(timeout=None) -> ModelHandlerV2:
+    """Waits for the model to load without blocking the event loop."""
+    if _model_future.done():
+        return _model_future.result()
+    return await asyncio.wait_for(
+        asyncio.shield(asyncio.wrap_future(_model_future)), timeout
+    )
 
 
 # async def get_embedding_model():
@@ -144,6 +390,13 @@ def _verify_github_signature(payload_body, secret_token, signature_header):
         raise HTTPException(status_code=403, detail="Request signatures didn't match!")
 
 
+_oembed_client = twitter.AsyncOEmbedClient(
+    max_concurrency=int(util.get_env_var("OEMBED_MAX_CONCURRENCY", 8))
+)
+# Cached tweet HTML is refetched after this long.
+TWEET_EMBED_TTL = timedelta(days=int(util.get_env_var("TWEET_EMBED_TTL_DAYS", 30)))
+
+
 @fastapi_app.get("/embed_tweets")
 async def embed_tweets(
     # to handle format of tweet_ids[]= rather than tweet_ids=
@@ -153,31 +406,71 @@ async def embed_tweets(
     if len(tweet_ids) > 50:
         raise HTTPException(status_code=403, detail="More than 50 tweet IDs")
 
-    async def get_embedded(tweet_id):
-        return twitter.getEmbeddedTweetHtml(tweet_id)
+    # Serve from the cache table, and only call the oEmbed API for the rest.
+    tweet_ids = [str(t) for t in tweet_ids]
+    htmls = await async_db.get_tweet_embeds(tweet_ids, max_age=TWEET_EMBED_TTL)
+    missing = [t for t in dict.fromkeys(tweet_ids) if t not in htmls]
+    if missing:
+        fetched = await _oembed_client.get_many(missing)
+        if fetched:
+            await async_db.insert_tweet_embeds(fetched)
+        htmls.update(fetched)
 
-    fns = [get_embedded(t) for t in tweet_ids]
-    results = await asyncio.gather(*fns)
-
-    return {"data": results}
+    return {"data": [htmls.get(t) for t in tweet_ids]}
 
 
 @fastapi_app.get("/tweets")
 async def get_tweets(arxiv_id: str):
     arxiv_id = arxiv_id[:100]
-    tweet_ids = db.get_arxiv_tweet_ids(arxiv_id)
+    tweet_ids = await async_db.get_arxiv_tweet_ids(arxiv_id)
     return {"data": tweet_ids}
 
 
 @fastapi_app.get("/hnews")
 async def get_tweets(arxiv_id: str):
     arxiv_id = arxiv_id[:100]
-    hnews_ids = db.get_arxiv_hnews_ids(arxiv_id)
+    hnews_ids = await async_db.get_arxiv_hnews_ids(arxiv_id)
     return {"data": hnews_ids}
 
 
+MAX_SOCIAL_ARXIV_IDS = 100
+# Time budget of each retriever in hybrid searches.
+RETRIEVER_TIMEOUT_MS = int(util.get_env_var("RETRIEVER_TIMEOUT_MS", 500))
+
+
+class SocialRequest(pydantic.BaseModel):
+    arxiv_ids: List[str]
+
+
+@fastapi_app.post("/social")
+async def get_social(request: SocialRequest):
+    """Returns the tweets and Hacker News items (with metrics) of many papers at once."""
+    if len(request.arxiv_ids) > MAX_SOCIAL_ARXIV_IDS:
+        raise HTTPException(
+            status_code=403, detail=f"More than {MAX_SOCIAL_ARXIV_IDS} arxiv IDs"
+        )
+    arxiv_ids = list(dict.fromkeys(a[:100] for a in request.arxiv_ids))
+    # New data bumps the version, so stale entries are never hit again.
+    version = _data_version.get()
+    social = {}
+    missing = []
+    for arxiv_id in arxiv_ids:
+        entry = _social_cache.get((version, arxiv_id))
+        if entry is None:
+            missing.append(arxiv_id)
+        else:
+            social[arxiv_id] = entry
+    if missing:
+        fetched = await async_db.get_social(missing)
+        for arxiv_id, entry in fetched.items():
+            _social_cache.put((version, arxiv_id), entry)
+        social.update(fetched)
+    return {"data": social}
+
+
 @fastapi_app.get("/search")
 async def search(
+    request: Request,
     query: str = "",
     top_k: int = 10,
     start_date: str = None,
@@ -185,6 +478,17 @@ async def search(
     require_social: bool = False,
     lexical_query: str = None,
     exclude_query: str = None,
+    exact: bool = False,
+    num_candidates: int = None,
+    semantic_weight: float = None,
+    lexical_weight: float = None,
+    popularity_weight: float = None,
+    recency_weight: float = None,
+    sort_by: str = "similarity",
+    retrieval: str = "vector",
+    fusion: str = "rrf",
+    aggregation: str = "mean",
+    query_weights: str = None,
 ):
     try:
         query = query.strip()
@@ -200,25 +504,120 @@ async def search(
         start_date = util.maybe_date_str_to_datetime(start_date)
         end_date = util.maybe_date_str_to_datetime(end_date)
         top_k = min(max(1, top_k), 500)
-        model = model_handler().get_embedding_model()
+        if num_candidates is not None:
+            num_candidates = min(max(top_k, num_candidates), 500)
+        # Rank server-side if any ranking weight is given.
+        weights = {
+            "semantic": semantic_weight,
+            "lexical": lexical_weight,
+            "popularity": popularity_weight,
+            "recency": recency_weight,
+        }
+        weights = {k: v for k, v in weights.items() if v is not None}
+        weights = ranking.RankingWeights(**weights) if weights else None
+        exact = exact or util.get_env_var("VECTOR_INDEX_EXACT", "0") == "1"
+        if retrieval not in search_lib.RETRIEVAL_MODES:
+            raise HTTPException(status_code=400, detail="Invalid retrieval mode")
+        if fusion not in search_lib.FUSION_METHODS:
+            raise HTTPException(status_code=400, detail="Invalid fusion method")
+        # How the parts of a "+"-separated query are combined, with optional
+        # comma-separated weights (one per part).
+        if aggregation not in vector_index.AGGREGATIONS:
+            raise HTTPException(status_code=400, detail="Invalid aggregation")
+        if query_weights:
+            try:
+                query_weights = [float(w) for w in query_weights.split(",")]
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid query weights")
+            if (
+                len(query_weights) != len(query.split("+"))
+                or min(query_weights) < 0
+                or sum(query_weights) <= 0
+            ):
+                raise HTTPException(status_code=400, detail="Invalid query weights")
+        else:
+            query_weights = None
+
+        # Results only change when the pipeline writes new data (bumping the data
+        # version), so identical searches can be served from the cache.
+        # Responses are JSON, or MessagePack if the client asks for it.
+        media_type = serialization.negotiate_media_type(request.headers.get("accept"))
+        version = _data_version.get()
+        # Everything that affects which papers are retrieved, as opposed to how they
+        # are ranked.
+        retrieval_key = [
+            version,
+            "+".join(ModelHandlerV2._normalize_query(q) for q in query.split("+")),
+            " ".join(lexical_query.split()) if lexical_query else None,
+            " ".join(exclude_query.split()) if exclude_query else None,
+            str(start_date),
+            str(end_date),
+            require_social,
+            num_candidates or top_k,
+            sort_by,
+            exact,
+            retrieval,
+            fusion,
+            aggregation,
+            query_weights if aggregation == "weighted" else None,
+        ]
+        cache_key = json.dumps(
+            [media_type, top_k, weights.dict() if weights else None, *retrieval_key]
+        )
+        body = _result_cache.get(cache_key)
+        if body is not None:
+            return Response(content=body, media_type=media_type)
+        maybe_refresh_vector_index()
+        # Read together, since the index may be swapped by a refresh meanwhile.
+        index, index_version = _vector_index, _vector_index_version
+        # Results of an index older than `version` would stay cached for the whole
+        # version, so only cache them once the index has caught up. Without an index,
+        # Postgres answers and the results are current.
+        cacheable = index is None or index_version == version
+        candidate_key = json.dumps(retrieval_key)
+
         # Allow query to be broken into multiple queries with "+"
         if query:
             # embeddings = []
             # for q in query.split("+"):
             #     embeddings.append(model.embed([q.strip()])[0])
-            embeddings = model.embed([q.strip() for q in query.split("+")])
+            embeddings = await ready_model_handler().embed_async(query.split("+"))
         else:
             embeddings = None
-        results = db.get_similar_papers(
+        results = await search_lib.search_papers(
+            async_db,
             embeddings=embeddings,
+            index=index,
+            exact=exact,
             lexical_query=lexical_query,
             exclude_query=exclude_query,
             top_k=top_k,
             start_date=start_date,
             end_date=end_date,
             require_social=require_social,
+            weights=weights,
+            lexical_rank_query=lexical_query or query.replace("+", " ") or None,
+            num_candidates=num_candidates,
+            order_by="popularity" if sort_by == "popularity" else "similarity",
+            retrieval=retrieval,
+            fusion=fusion,
+            aggregation=aggregation,
+            query_weights=query_weights,
+            retriever_timeout_ms=RETRIEVER_TIMEOUT_MS,
+            candidate_cache=_candidate_cache if cacheable else None,
+            candidate_key=candidate_key,
         )
-        return {"data": results}
+        body = serialization.encode(
+            serialization.search_response(results), media_type=media_type
+        )
+        if cacheable:
+            _result_cache.put(cache_key, body)
+        return Response(content=body, media_type=media_type)
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        # Hybrid retrieval ran out of time in both retrievers. Don't cache that.
+        raise HTTPException(status_code=503, detail="Search timed out, try again.")
     except Exception as ex:
         logging.error(ex)
         raise ex
@@ -227,10 +626,15 @@ async def search(
 
 
 def _run_pipeline(start_dt=None, embedding_model=None):
+    from pipeline import run_pipeline
+
     logging.info(
         f"Running pipeline with start_dt={start_dt}, embedding_model={embedding_model}"
     )
     run_pipeline.run(start_dt=start_dt, embedding_model=embedding_model)
+    # The pipeline bumped the data version, so reload the index (from the snapshot it
+    # wrote, if snapshots are enabled) without waiting for the next search.
+    refresh_vector_index()
 
 
 def _keep_server_alive(duration, base_url):
@@ -302,6 +706,37 @@ async def gh_webhook_update_db(request: Request):
 #     return {"hello": "world"}
 
 
+@fastapi_app.get("/stats")
+async def stats():
+    return {
+        "query_embedding_cache": (
+            _model_handler.cache.stats() if _model_handler is not None else None
+        ),
+        "inference": (
+            _model_handler.embedder.stats() if _model_handler is not None else None
+        ),
+        "search_result_cache": _result_cache.stats(),
+        "candidate_cache": _candidate_cache.stats(),
+        "social_cache": _social_cache.stats(),
+        "data_version": _data_version.get(),
+    }
+
+
+@fastapi_app.get("/ready")
+async def ready(timeout: float = 0):
+    """Responds with 200 once the model is loaded and 503 until then. Waits up to
+    `timeout` seconds for it to load."""
+    try:
+        await wait_for_model_handler(timeout=min(max(timeout, 0), 30))
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail="Model is loading.",
+            headers={"Retry-After": str(MODEL_LOADING_RETRY_AFTER)},
+        )
+    return {"ready": True}
+
+
 @fastapi_app.get("/ping")
 async def ping(request: Request):
     return {"ping": random.random()}
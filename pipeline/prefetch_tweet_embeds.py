@@ -0,0 +1,29 @@
+from lib import database, twitter
+import asyncio
+import logging
+
+
+async def _fetch(tweet_ids, max_concurrency):
+    client = twitter.AsyncOEmbedClient(max_concurrency=max_concurrency)
+    try:
+        return await client.get_many(tweet_ids)
+    finally:
+        await client.aclose()
+
+
+def run(tweet_ids, max_concurrency=8):
+    """Caches the embedded HTML of tweets that aren't cached yet, so opening them in the
+    UI only needs a database read.
+
+    Args:
+        tweet_ids: Tweets to prefetch, e.g. the ones just ingested.
+        max_concurrency: Maximum number of concurrent oEmbed requests.
+    """
+    db = database.Database()
+    tweet_ids = [str(t) for t in tweet_ids]
+    cached = db.get_tweet_embeds(tweet_ids)
+    missing = [t for t in dict.fromkeys(tweet_ids) if t not in cached]
+    logging.info(f"Prefetching {len(missing)} tweet embeds")
+    htmls = asyncio.run(_fetch(missing, max_concurrency))
+    db.insert_tweet_embeds(htmls)
+    logging.info(f"Cached {len(htmls)} tweet embeds")
@@ -14,8 +14,8 @@ def run(start_dt=None, num_results=100, order_by="date"):
 
     # Add results to DB
     logging.info(f"Found {len(posts)} hnews posts.")
-    db.insert_hnews(posts)
-    db.update_arxiv_social_metrics(update_hnews=True)
+    arxiv_ids = db.insert_hnews(posts)
+    db.update_arxiv_social_metrics(update_hnews=True, arxiv_ids=arxiv_ids)
 
 
 if __name__ == "__main__":
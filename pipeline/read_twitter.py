@@ -19,8 +19,9 @@ def run(start_dt=None, max_results=1000, num_time_blocks=None):
 
     # Add results to DB
     logging.info(f"Found {len(tweets)} tweets.")
-    db.insert_tweets(tweets)
-    db.update_arxiv_social_metrics(update_twitter=True)
+    arxiv_ids = db.insert_tweets(tweets)
+    db.update_arxiv_social_metrics(update_twitter=True, arxiv_ids=arxiv_ids)
+    return [t.tweet_id for t in tweets]
 
 
 if __name__ == "__main__":
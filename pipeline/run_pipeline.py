@@ -1,17 +1,22 @@
 import logging
 
+from lib import cache, util
 from pipeline import (
+    prefetch_tweet_embeds,
     read_twitter,
     read_hnews,
     update_arxiv_data,
     update_arxiv_embeddings,
+    write_index_snapshot,
 )
 
 
 def run(embedding_model=None, start_dt=None):
     logging.info("Handling Twitter")
     # read_twitter.run(start_dt=start_dt, max_results=50, num_time_blocks=3)
-    read_twitter.run(max_results=1000)
+    tweet_ids = read_twitter.run(max_results=1000)
+    if util.get_env_var("PREFETCH_TWEET_EMBEDS", "0") == "1":
+        prefetch_tweet_embeds.run(tweet_ids)
     logging.info("Handling Hacker News")
     # API max is 1000 results
     # Fetch most recent
@@ -22,4 +27,10 @@ def run(embedding_model=None, start_dt=None):
     update_arxiv_data.run()
     logging.info("Handling arxiv embeddings")
     update_arxiv_embeddings.run(embedding_model=embedding_model)
+    # Written before the data version is bumped, so workers reloading on the new
+    # version find the new snapshot.
+    logging.info("Writing vector index snapshot")
+    write_index_snapshot.run()
+    # Invalidate cached search results.
+    cache.DataVersion().bump()
     logging.info("Done.")
@@ -1,38 +1,91 @@
-from lib import database, embedding
+from lib import arxiv, database, embedding, util
+from concurrent import futures
+from collections import deque
+import multiprocessing
 import logging
+import os
 
+# Model loaded once per worker process (see _init_worker).
+_worker_model = None
 
-def run(embedding_model=None):
-    def embed_papers(papers):
-        abstracts = [p.abstract for p in papers]
-        embeddings = iter(t.embed(abstracts))
-        for p in papers:
-            p.embedding = next(embeddings)
 
-    if embedding_model is None:
-        t = embedding.SentenceTransformer()
-    else:
-        t = embedding_model
+def _init_worker(num_threads):
+    global _worker_model
+    _worker_model = embedding.SentenceTransformer(num_threads=num_threads)
+
+
+def _embed_in_worker(arxiv_ids, abstracts):
+    return arxiv_ids, _worker_model.embed_many(abstracts)
+
+
+def _embed_batches_in_process(model, batches):
+    for batch in batches:
+        yield [p.arxiv_id for p in batch], model.embed_many([p.abstract for p in batch])
+
+
+def _embed_batches_in_pool(batches, num_workers):
+    """Embeds batches on a pool of worker processes, keeping at most 2 batches per
+    worker in flight so memory stays bounded. Yields results in submission order."""
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    with futures.ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(
+                executor.submit(
+                    _embed_in_worker,
+                    [p.arxiv_id for p in batch],
+                    [p.abstract for p in batch],
+                )
+            )
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run(embedding_model=None, num_workers=None, batch_size=256, upload_every=2048):
+    """Computes embeddings for every paper that is missing one.
+
+    Args:
+        embedding_model: Model to embed with in this process. If None, a pool of
+            `num_workers` processes each loads its own model.
+        num_workers: Number of worker processes. Defaults to the number of CPUs.
+        batch_size: Number of abstracts sent to a worker at once.
+        upload_every: Number of embeddings written to the DB at once.
+    """
     db = database.Database()
-    papers = db.get_papers(ids_only=False, required_null_fields=["embedding"])
-    papers = [r.paper for r in papers]
-    logging.info(f"Found {len(papers)} missing embeddings.")
-    batch_size = 8
-    upload_every = batch_size * 10
+    # Embeddings are written while iterating, so page with keyset queries rather
+    # than holding a cursor's transaction open for the whole run.
+    papers = db.iter_papers(
+        filters=database.PaperFilters(required_null_fields=["embedding"]),
+        columns=["arxiv_id", "abstract"],
+        keyset=True,
+    )
+    batches = util.batched((r.paper for r in papers if r.paper.abstract), batch_size)
+    if embedding_model is not None:
+        results = _embed_batches_in_process(embedding_model, batches)
+    else:
+        num_workers = num_workers or os.cpu_count() or 1
+        logging.info(f"Embedding with {num_workers} worker processes.")
+        results = _embed_batches_in_pool(batches, num_workers)
 
     embedded_papers = []
     num_processed = 0
-    total = len(papers)
-    while len(papers):
-        batch = papers[:batch_size]
-        num_processed += len(batch)
-        papers = papers[batch_size:]
-        embed_papers(batch)
-        embedded_papers.extend(batch)
+    for arxiv_ids, embeddings in results:
+        for arxiv_id, e in zip(arxiv_ids, embeddings):
+            paper = arxiv.ArxivPaper(arxiv_id=arxiv_id)
+            paper.embedding = e
+            embedded_papers.append(paper)
+        num_processed += len(arxiv_ids)
         if len(embedded_papers) >= upload_every:
             db.insert_papers(embedded_papers, insert_type="embeddings")
             embedded_papers = []
-        logging.info(f"Embedded {num_processed}/{total}")
+        logging.info(f"Embedded {num_processed} papers")
     db.insert_papers(embedded_papers, insert_type="embeddings")
     logging.info("Done updating embeddings.")
 
@@ -0,0 +1,29 @@
+from lib import database, util, vector_index
+import logging
+
+
+def run(snapshot_dir=None):
+    """Builds the vector index from the stored embeddings and saves it as a snapshot
+    that web workers memory-map, instead of each rebuilding it from the DB.
+
+    Args:
+        snapshot_dir: Directory holding the snapshots. Defaults to
+            VECTOR_INDEX_SNAPSHOT_DIR. Nothing is written if neither is set.
+
+    Returns:
+        Path of the new snapshot, or None if none was written.
+    """
+    snapshot_dir = snapshot_dir or util.get_env_var("VECTOR_INDEX_SNAPSHOT_DIR")
+    if not snapshot_dir:
+        logging.info("VECTOR_INDEX_SNAPSHOT_DIR is not set, skipping index snapshot.")
+        return None
+    index = vector_index.build_from_database(
+        database.Database(), **vector_index.config_from_env()
+    )
+    if index is None:
+        return None
+    return vector_index.save_snapshot(index, snapshot_dir)
+
+
+if __name__ == "__main__":
+    run()
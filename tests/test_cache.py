@@ -0,0 +1,19 @@
+from lib import cache
+
+
+def test_data_version_is_stored_next_to_persisted_cache(monkeypatch, tmp_path):
+    monkeypatch.delenv("DATA_VERSION_PATH", raising=False)
+    cache_path = str(tmp_path / "search_cache.sqlite")
+    monkeypatch.setenv("SEARCH_CACHE_PATH", cache_path)
+    version = cache.DataVersion()
+    assert version.path == f"{cache_path}.data_version"
+    version.bump()
+    # A new process (e.g. after a restart) sees the same version.
+    assert cache.DataVersion().get() == 1
+
+
+def test_data_version_path_can_be_overridden(monkeypatch, tmp_path):
+    path = str(tmp_path / "version")
+    monkeypatch.setenv("DATA_VERSION_PATH", path)
+    monkeypatch.setenv("SEARCH_CACHE_PATH", str(tmp_path / "search_cache.sqlite"))
+    assert cache.DataVersion().path == path
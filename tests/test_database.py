@@ -0,0 +1,46 @@
+from lib import database
+from datetime import datetime
+
+
+def _filters(start_date, end_date):
+    return database.Database._similar_papers_filters(
+        start_date, end_date, False, None, None
+    )
+
+
+def test_arxiv_id_bounds_within_yymm_range():
+    conditions, args = _filters(datetime(2023, 1, 15), datetime(2023, 3, 2))
+    assert "arxiv_id >= %s" in conditions
+    assert "arxiv_id < %s" in conditions
+    assert "2212" in args
+    assert "2305" in args
+
+
+def test_no_arxiv_id_upper_bound_after_2099():
+    conditions, args = _filters(datetime(2023, 1, 15), datetime(2100, 6, 1))
+    assert "arxiv_id >= %s" in conditions
+    assert "arxiv_id < %s" not in conditions
+    # Two months of slack past November 2099 would also wrap.
+    conditions, _ = _filters(datetime(2023, 1, 15), datetime(2099, 11, 1))
+    assert "arxiv_id < %s" not in conditions
+
+
+def test_no_arxiv_id_bounds_outside_yymm_range():
+    conditions, _ = _filters(datetime(1990, 1, 1), datetime(2023, 1, 1))
+    assert not any("arxiv_id" in c for c in conditions)
+    conditions, _ = _filters(datetime(2100, 2, 1), datetime(2100, 3, 1))
+    assert not any("arxiv_id" in c for c in conditions)
+
+
+def test_arxiv_id_month_bound():
+    assert database.arxiv_id_month_bound(datetime(2023, 1, 15), -1) == "2212"
+    assert database.arxiv_id_month_bound(datetime(2099, 12, 1), 2) is None
+    assert database.arxiv_id_month_bound(datetime(2000, 1, 1)) is None
+
+
+def test_require_social_ignores_impressions():
+    conditions, _ = database.Database._similar_papers_filters(
+        None, None, True, None, None
+    )
+    assert database.SOCIAL_ENGAGEMENT_SQL in conditions
+    assert "impressions" not in " ".join(conditions)
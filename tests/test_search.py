@@ -0,0 +1,94 @@
+from lib import arxiv, cache, database, ranking, search
+import asyncio
+import pytest
+
+
+def _result(arxiv_id, similarity):
+    return database.SimilarityResult(
+        entity=database.ArxivEntity(paper=arxiv.ArxivPaper(arxiv_id=arxiv_id)),
+        similarity=similarity,
+    )
+
+
+class FakeDatabase:
+    """Serves fixed vector and lexical rankings in place of AsyncDatabase."""
+
+    def __init__(self, similarities, lexical, lexical_delay=0):
+        self.similarities = similarities
+        self.lexical = lexical
+        self.lexical_delay = lexical_delay
+        self.num_queries = 0
+
+    async def get_similar_papers(self, embeddings=None, candidates=None, **kwargs):
+        self.num_queries += 1
+        if candidates is None:
+            candidates = self.similarities
+        return [_result(arxiv_id, sim) for arxiv_id, sim in candidates.items()]
+
+    async def get_lexical_candidates(self, query, embeddings=None, **kwargs):
+        await asyncio.sleep(self.lexical_delay)
+        return [
+            (arxiv_id, rank, self.similarities[arxiv_id])
+            for arxiv_id, rank in self.lexical
+        ]
+
+
+def _hybrid_search(db, weights, timeout_ms=None):
+    return asyncio.run(
+        search.search_papers(
+            db,
+            embeddings=[[1.0, 0.0]],
+            top_k=3,
+            weights=weights,
+            lexical_rank_query="sparse attention",
+            retrieval="hybrid",
+            retriever_timeout_ms=timeout_ms,
+        )
+    )
+
+
+def test_hybrid_search_keeps_fused_order():
+    # "a" is the most similar paper, but "b" and "c" are also lexical matches, so
+    # reciprocal rank fusion puts them first. Blending similarity and lexical rank
+    # instead would put "a" before "c", whose lexical rank is low.
+    db = FakeDatabase(
+        similarities={"a": 0.9, "b": 0.8, "c": 0.7},
+        lexical=[("b", 1.0), ("c", 0.01)],
+    )
+    weights = ranking.RankingWeights(semantic=100, lexical=100, popularity=0)
+    results = _hybrid_search(db, weights)
+    assert [r.entity.paper.arxiv_id for r in results] == ["b", "c", "a"]
+
+
+def test_hybrid_search_raises_when_both_retrievers_time_out():
+    class SlowDatabase(FakeDatabase):
+        async def get_similar_papers(self, embeddings=None, **kwargs):
+            await asyncio.sleep(1)
+
+    db = SlowDatabase(similarities={}, lexical=[], lexical_delay=1)
+    with pytest.raises(asyncio.TimeoutError):
+        _hybrid_search(db, ranking.RankingWeights(lexical=50), timeout_ms=10)
+
+
+def test_reranking_reuses_cached_candidates():
+    db = FakeDatabase(similarities={"a": 0.9, "b": 0.8, "c": 0.7}, lexical=[])
+    candidate_cache = cache.LRUCache()
+
+    def ranked_search(weights):
+        results = asyncio.run(
+            search.search_papers(
+                db,
+                embeddings=[[1.0, 0.0]],
+                top_k=2,
+                num_candidates=3,
+                weights=weights,
+                candidate_cache=candidate_cache,
+                candidate_key="query",
+            )
+        )
+        return [r.entity.paper.arxiv_id for r in results]
+
+    assert ranked_search(ranking.RankingWeights(popularity=0)) == ["a", "b"]
+    # Only the popularity weight changed, so the candidates are re-ranked as is.
+    assert ranked_search(ranking.RankingWeights(popularity=50)) == ["a", "b"]
+    assert db.num_queries == 1